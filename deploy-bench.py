@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#
+# Offline benchmark of deploy-script.py. Serves TeamCity and BitBucket endpoints
+# from a local stub and runs the release main() against it.
+#
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SIZES = '10,100,1000,2000'
+PAGE_SIZE = 100 # TeamCity default page size
+REPOS_PER_BUILD = 0.5 # builds in a bundle share VCS roots
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers TeamCity and BitBucket API requests from fixtures or a generated dependency graph"""
+    protocol_version = 'HTTP/1.1' # keep-alive, so connection reuse is visible
+    disable_nagle_algorithm = True # headers and body go out separately, don't wait on delayed ACKs
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(format % args)
+
+    def do_GET(self) -> None:
+        self.answer('GET')
+
+    def do_POST(self) -> None:
+        self.answer('POST')
+
+    def do_PUT(self) -> None:
+        self.answer('PUT')
+
+    def do_DELETE(self) -> None:
+        self.answer('DELETE')
+
+    def answer(self, method) -> None:
+        self.server.count('requests')
+        request = json.loads(self.rfile.read(length)) if (length := int(self.headers.get('Content-Length', 0))) else {}
+        time.sleep(self.server.latency)
+
+        url = urlsplit(self.path)
+        status, body = self.server.fixtures.get(f'{method} {url.path}') or self.server.generate(method, url.path, parse_qs(url.query), request)
+        payload = json.dumps(body).encode('utf8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class StubServer(ThreadingHTTPServer):
+    """Stub of a TeamCity bundle with `builds` dependency builds and the BitBucket repositories they are built from"""
+    daemon_threads = True
+
+    def __init__(self, builds, latency=0.0, fixtures={}) -> None:
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.builds = builds
+        self.repos = max(1, int(builds * REPOS_PER_BUILD))
+        self.latency = latency
+        self.fixtures = fixtures
+        self.counters = {'requests': 0, 'connections': 0}
+        self.tags = {} # {(repository, tag): hash} created by the release
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def count(self, counter) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def generate(self, method, path, query, request) -> tuple:
+        """Returns (status, JSON body) for the request"""
+        if method == 'GET' and path.endswith('/resulting-properties'):
+            return 200, {'property': [
+                {'name': f'dep.bt{b}.system.build.number', 'value': str(b)}
+                for b in range(self.builds)
+            ]}
+        if method == 'POST' and path.endswith('/tags') and path.startswith('/app/rest/'):
+            return 200, {'count': 1, 'tag': [{'name': 'release'}]}
+        if method == 'GET' and path == '/app/rest/builds':
+            locator = query.get('locator', [''])[0]
+            start = int(m.group(1)) if (m := re.search(r'start:(\d+)', locator)) else 0
+            body = {'build': [
+                {'href': f'/app/rest/builds/id:{b}'}
+                for b in range(start, min(start + PAGE_SIZE, self.builds))
+            ]}
+            if start + PAGE_SIZE < self.builds:
+                base = re.sub(r',?start:\d+', '', locator)
+                body['nextHref'] = f'/app/rest/builds?locator={base},start:{start + PAGE_SIZE}'
+            return 200, body
+        if method == 'PUT' and path.endswith('/pinInfo'):
+            return 200, {'status': True}
+        if method == 'GET' and (m := re.match(r'/app/rest/builds/id:(\d+)$', path)):
+            b = int(m.group(1))
+            return 200, {'revisions': {'revision': [{
+                'version': f'{b % self.repos:040x}',
+                'vcs-root-instance': {'vcs-root-id': f'repo{b % self.repos}', 'href': f'/app/rest/vcs-root-instances/id:{b % self.repos}'},
+            }]}}
+        if method == 'GET' and (m := re.match(r'/app/rest/vcs-root-instances/id:(\d+)$', path)):
+            return 200, {'properties': {'property': [{'name': 'url', 'value': f'git@bitbucket.org:bench/repo{m.group(1)}.git'}]}}
+        if method == 'GET' and path.endswith('/refs/tags'):
+            name = m.group(1) if (m := re.search(r'name="([^"]*)"', query.get('q', [''])[0])) else None
+            return 200, {'values': [
+                {'name': tag, 'target': {'hash': hash}}
+                for (repo, tag), hash in list(self.tags.items())
+                if repo == path and name in (None, tag)
+            ]}
+        if method == 'POST' and path.endswith('/refs/tags'):
+            self.tags[path, request.get('name')] = request.get('target', {}).get('hash')
+            return 201, {'type': 'tag'}
+        if method == 'DELETE' and (m := re.match(r'(.*/refs/tags)/(.*)$', path)):
+            return (204, None) if self.tags.pop(m.groups(), None) else (404, {'type': 'error'})
+        return 404, {'error': f'{method} {path} is not stubbed'}
+
+def load_deploy_script():
+    """Returns freshly imported deploy-script.py module, so no state is shared between runs"""
+    spec = importlib.util.spec_from_file_location('deploy_script', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deploy-script.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench(builds, latency, fixtures, extra_args) -> dict:
+    """Runs the release against a stub of `builds` builds and returns the measurements"""
+    server = StubServer(builds, latency, fixtures)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    deploy_script = load_deploy_script()
+
+    tracemalloc.start()
+    start = time.monotonic()
+    status = deploy_script.main([
+        '--build', '1', '--release', 'bench',
+        '--bb-username', 'bench', '--bb-password', 'bench', '--tc-token', 'bench',
+        '--tc-url', server.url, '--bb-url', server.url,
+    ] + extra_args)
+    wall = time.monotonic() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    server.shutdown()
+    server.server_close()
+    return {
+        'builds': builds,
+        'status': status,
+        'wall': wall,
+        'requests': server.counters['requests'],
+        'connections': server.counters['connections'],
+        'peak_kb': peak // 1024,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark deploy-script.py against a local TeamCity/BitBucket stub')
+    parser.add_argument('--sizes', default=SIZES, help='Comma separated numbers of dependency builds in the bundle')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stub takes to answer each request')
+    parser.add_argument('--fixtures', default=None, help='JSON file of {"METHOD /path": [status, body]} recorded responses')
+    parser.add_argument('--json', default=False, action='store_true', help='Print the results as JSON lines')
+    args, extra_args = parser.parse_known_args()
+
+    fixtures = {}
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+
+    # arguments not known here go to deploy-script.py, e.g. --workers 16 or --delete
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    extra_args = extra_args or ['-qq']
+
+    if not args.json:
+        print(f"{'builds':>7} {'status':>6} {'wall s':>8} {'requests':>9} {'conns':>6} {'peak KB':>8} {'maxrss KB':>10}")
+    for builds in map(int, args.sizes.split(',')):
+        result = bench(builds, args.latency, fixtures, extra_args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{result['builds']:>7} {result['status']:>6} {result['wall']:>8.2f} {result['requests']:>9} "
+                  f"{result['connections']:>6} {result['peak_kb']:>8} {result['maxrss_kb']:>10}")
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
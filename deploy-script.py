@@ -4,99 +4,451 @@
 #
 import argparse
 import base64
+import hashlib
+import json as jsonlib
 import logging
+import os
 import re
 import requests
 import sys
+import threading
+import time
 import http.client as http_client
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from functools import reduce
-from itertools import chain
 from pprint import pformat as pformat
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 TIMEOUT = 3000/1000 # 3s connect timeout
+WORKERS = min(32, (os.cpu_count() or 1) + 4) # ThreadPoolExecutor default
+RETRIES = 3
+BACKOFF = 0.5 # sleeps 0.5s, 1s, 2s between retries
+PAGERS = 4 # threads fetching the next pages of TeamCity collections
+THROTTLE_RETRIES = 10 # attempts of a request answered with 429 Too Many Requests
+HISTOGRAM_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf')) # request latency, seconds
+
+def tc_fields(spec) -> str:
+    """Returns TeamCity fields= selector for nested lists/dicts of field names,
+    e.g. ['nextHref', {'build': ['href']}] -> 'nextHref,build(href)'"""
+    if isinstance(spec, str):
+        return spec
+    if isinstance(spec, dict):
+        return ','.join(f'{name}({tc_fields(nested)})' for name, nested in spec.items())
+    return ','.join(map(tc_fields, spec))
+
+# only the attributes each stage of the release reads
+PROPERTIES_FIELDS = tc_fields({'property': ['name', 'value']})
+BUILDS_FIELDS = tc_fields(['nextHref', {'build': ['href']}])
+REVISIONS_FIELDS = tc_fields({'revisions': {'revision': ['version', {'vcs-root-instance': ['vcs-root-id', 'href']}]}})
+VCS_ROOT_FIELDS = tc_fields({'properties': {'property': ['name', 'value']}})
+
+def make_session(authorization, workers=WORKERS, retries=RETRIES, backoff=BACKOFF, respect_retry_after=True, allowed_methods=None) -> requests.Session:
+    """Returns keep-alive session with a connection pool sized to the worker threads.
+
+    Without respect_retry_after urllib3 leaves 429 responses to the caller instead of sleeping on them.
+    allowed_methods are the verbs retried on a 5xx, None retries every verb."""
+    session = requests.Session()
+    session.headers.update({
+        'Accept': 'application/json',
+        'Authorization': authorization,
+    })
+    adapter = HTTPAdapter(
+        pool_maxsize=workers,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=allowed_methods,
+            raise_on_status=False,
+            respect_retry_after_header=respect_retry_after,
+        ),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class LazyFormat:
+    """Pretty-prints the object only when the log record is emitted, e.g. logging.debug(LazyFormat(api_json))"""
+
+    def __init__(self, obj) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return pformat(self.obj)
+
+class Tracer:
+    """Records a span per API request: endpoint, status, bytes, latency and retries"""
+
+    def __init__(self) -> None:
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, service, method, endpoint, response, latency, retries=0) -> None:
+        # urllib3 keeps the connection and 5xx retries of the request in its history
+        retries += len(getattr(getattr(response.raw, 'retries', None), 'history', None) or ())
+        with self.lock:
+            self.spans.append({
+                'service': service,
+                'method': method.upper(),
+                'endpoint': endpoint.split('?')[0],
+                'status': response.status_code,
+                'bytes': len(response.content),
+                'latency': latency,
+                'retries': retries,
+            })
+
+    def summary(self, slowest=10) -> str:
+        """Returns table of the slowest endpoints, with ids collapsed, and a histogram of all request latencies"""
+        endpoints = {}
+        for span in self.spans:
+            key = (span['service'], span['method'], re.sub(r'\d+', '#', span['endpoint']))
+            stats = endpoints.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'retries': 0})
+            stats['count'] += 1
+            stats['total'] += span['latency']
+            stats['max'] = max(stats['max'], span['latency'])
+            stats['bytes'] += span['bytes']
+            stats['retries'] += span['retries']
+
+        lines = [f'{len(self.spans)} requests, slowest endpoints by total time:',
+                 f"{'total s':>9} {'count':>6} {'avg ms':>8} {'max ms':>8} {'KB':>8} {'retries':>7}  endpoint"]
+        for (service, method, endpoint), stats in sorted(endpoints.items(), key=lambda e: -e[1]['total'])[:slowest]:
+            lines.append(f"{stats['total']:>9.2f} {stats['count']:>6} {1000 * stats['total'] / stats['count']:>8.1f} "
+                         f"{1000 * stats['max']:>8.1f} {stats['bytes'] // 1024:>8} {stats['retries']:>7}  {service} {method} {endpoint}")
+
+        lines.append('latency histogram:')
+        counts = [0] * len(HISTOGRAM_BUCKETS)
+        for span in self.spans:
+            counts[next(i for i, bound in enumerate(HISTOGRAM_BUCKETS) if span['latency'] < bound)] += 1
+        for bound, count in zip(HISTOGRAM_BUCKETS, counts):
+            lines.append(f"{'< ' + (f'{bound * 1000:g}ms' if bound < float('inf') else 'inf'):>10} {count:>6} {'#' * (60 * count // max(1, max(counts)))}")
+        return '\n'.join(lines)
+
+class TaskGraph:
+    """Runs tasks on the executor as soon as their inputs are ready.
+
+    A task hands its results on by submitting the tasks which depend on them,
+    so the whole graph finishes in the time of its critical path."""
+
+    def __init__(self, executor) -> None:
+        self.executor = executor
+        self.pending = 0
+        self.errors = []
+        self.condition = threading.Condition()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Schedules fn(*args, **kwargs) and counts it as pending until it returns"""
+        with self.condition:
+            self.pending += 1
+        return self.executor.submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logging.exception(f'Task {fn.__name__}{args} failed')
+            with self.condition:
+                self.errors.append(e)
+            raise
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def wait(self) -> None:
+        """Blocks until every task, including the ones submitted by other tasks, has finished"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+
+class Once:
+    """Remembers keys, so work shared by several releases in a run is done only once"""
+
+    def __init__(self) -> None:
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def first(self, key) -> bool:
+        """Returns True for the first caller with the key"""
+        with self.lock:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            return True
+
+class Journal:
+    """Append-only JSON lines record of the completed release operations and the data they resolved.
+
+    A rerun of the same build and release reloads it and only issues the remaining calls.
+    Without a path the journal is kept in memory only."""
+
+    def __init__(self, path=None) -> None:
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+        if path:
+            if os.path.isfile(path):
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entry = jsonlib.loads(line)
+                        except ValueError:
+                            break # the line being written when the last run died
+                        self.entries.pop(entry.get('undo'), None)
+                        self.entries[entry.get('op')] = entry.get('data')
+                logging.info(f'Resuming from {path} with {len(self.entries)} completed operations')
+            self.file = open(path, 'a')
+
+    def done(self, op) -> bool:
+        return op in self.entries
+
+    def get(self, op):
+        """Returns data recorded with the operation, None if it was not done"""
+        return self.entries.get(op)
+
+    def record(self, op, data=True, undo=None) -> None:
+        """Records the operation as done, forgetting the `undo` operation it reverses"""
+        with self.lock:
+            self.entries.pop(undo, None)
+            self.entries[op] = data
+            if self.file:
+                self.file.write(jsonlib.dumps({'op': op, 'data': data, 'undo': undo}) + '\n')
+                self.file.flush()
+
+class AdaptiveLimiter:
+    """Limits the requests in flight to a service, adapting the limit AIMD style.
+
+    Every successful request grows the limit by 1/limit, so by one per round
+    of requests; a throttled one halves it and pauses all the requests for
+    the Retry-After time. The requests already in flight when the limit was
+    halved belong to the same congestion event, their 429s only pause."""
+
+    def __init__(self, limit=WORKERS, minimum=1) -> None:
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = limit
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.decreased_at = float('-inf')
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> float:
+        """Blocks until the request may be sent, returns the time it was let through for release()"""
+        with self.condition:
+            while (pause := self.resume_at - time.monotonic()) > 0 or self.in_flight >= int(self.limit):
+                self.condition.wait(timeout=pause if pause > 0 else None)
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, retry_after=None, sent=None) -> None:
+        """Finishes the request sent at `sent`, retry_after is set when the service throttled it"""
+        with self.condition:
+            self.in_flight -= 1
+            if retry_after is None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.throttled += 1
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+                if sent is None or sent >= self.decreased_at:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.decreased_at = time.monotonic()
+                    logging.warning(f'Throttled, limiting to {int(self.limit)} requests for {retry_after:.1f}s')
+            self.condition.notify_all()
+
+def retry_after(response, default) -> float:
+    """Returns seconds to wait from the Retry-After header, which is either seconds or an HTTP date"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+
+def response_json(response) -> dict:
+    """Returns JSON body of the response, or the status and text of a non-JSON error response"""
+    try:
+        return response.json()
+    except ValueError:
+        return {'status': response.status_code, 'error': response.text}
 
 class BitBucketApi:
     BASE_URL = 'https://api.bitbucket.org'
 
-    def __init__(self, username='', password='', **kwargs) -> None:
+    def __init__(self, username='', password='', workers=WORKERS, retries=RETRIES, backoff=BACKOFF, bb_url=None, tracer=None, **kwargs) -> None:
         """Inits API class using bitbucket app username/password"""
+        self.BASE_URL = bb_url or self.BASE_URL
         self.authorization = f"Basic {base64.b64encode(f'{username}:{password}'.encode('utf8')).decode('utf8')}"
+        # 429s have to reach _send, so the limiter sees them and backs off.
+        # A repeated tag POST fails with "already exists", so POST is not retried on a 5xx,
+        # the tag plan of the next run picks up a tag which did get created
+        self.session = make_session(self.authorization, workers, retries, backoff, respect_retry_after=False,
+                                    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS)
+        self.limiter = AdaptiveLimiter(workers)
+        self.backoff = backoff
+        self.tracer = tracer
 
     def get(self, endpoint, params={}) -> dict:
         """Returns JSON from API call to specified endpoint"""
         logging.info(f'BitBucket API GET request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_json := requests.get(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        logging.debug(LazyFormat(api_json := response_json(self._request(
+            'get',
+            endpoint,
             params=params
-        ).json()))
+        ))))
         return api_json
 
     def post(self, endpoint, json={}) -> dict:
         """Returns JSON from API call to specified endpoint"""
         logging.info(f'BitBucket API POST request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_json := requests.post(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        logging.debug(LazyFormat(api_json := response_json(self._request(
+            'post',
+            endpoint,
             json=json
-        ).json()))
+        ))))
         return api_json
 
+    def iter_pages(self, endpoint, params={}):
+        """Yields values of a paged BitBucket collection, following the next links"""
+        while endpoint:
+            api_json = self.get(endpoint, params)
+            yield from api_json.get('values') or []
+            endpoint, params = api_json.get('next'), {} # next carries the query already
+
     def delete(self, endpoint, json={}) -> str:
         """Returns JSON from API call to specified endpoint"""
         logging.info(f'BitBucket API DELETE request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_str := requests.delete(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        logging.debug(LazyFormat(api_str := self._request(
+            'delete',
+            endpoint,
             json=json
         ).content))
         return api_str
 
+    def _request(self, method, endpoint, **kwargs) -> requests.Response:
+        """Returns response of the request, raising on an error status so the task fails and nothing is journaled"""
+        if not (response := self._send(method, endpoint, **kwargs)).ok:
+            raise requests.HTTPError(
+                f'BitBucket API {method.upper()} {endpoint.replace(self.BASE_URL, "")} failed: {response.status_code} {response.text[:200]}',
+                response=response,
+            )
+        return response
+
+    def _send(self, method, endpoint, **kwargs) -> requests.Response:
+        """Returns response of the request sent through the rate limiter, retrying it while throttled"""
+        for attempt in range(THROTTLE_RETRIES):
+            sent = self.limiter.acquire()
+            try:
+                start = time.monotonic()
+                response = self.session.request(
+                    method,
+                    f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
+                    timeout=TIMEOUT,
+                    **kwargs
+                )
+            except Exception:
+                self.limiter.release()
+                raise
+
+            if self.tracer:
+                self.tracer.record('BitBucket', method, endpoint.replace(self.BASE_URL, ""), response, time.monotonic() - start, attempt)
+            if response.status_code != 429:
+                self.limiter.release()
+                return response
+            self.limiter.release(retry_after(response, self.backoff * 2 ** attempt), sent)
+        return response
+
 class TeamCityApi:
     BASE_URL = 'https://teamcity.int.archer.com'
 
-    def __init__(self, token='', **kwargs) -> None:
-        """Inits API class using teamcity bearer token"""
+    def __init__(self, token='', workers=WORKERS, retries=RETRIES, backoff=BACKOFF, cache_dir=None, tc_url=None, tracer=None, **kwargs) -> None:
+        """Inits API class using teamcity bearer token, optionally revalidating GETs cached in cache_dir"""
+        self.BASE_URL = tc_url or self.BASE_URL
         self.authorization = f'Bearer {token}'
+        # Pins are PUT and the build tags are a set, repeating any TeamCity write is harmless
+        self.session = make_session(self.authorization, workers, retries, backoff)
+        self.cache_dir = cache_dir
+        self.tracer = tracer
+        self.cache = {} # { (endpoint, params): Future } of every GET in this run
+        self.cache_lock = threading.Lock()
+        # separate from the main executor so a task consuming pages never waits on a busy pool
+        self.pager = ThreadPoolExecutor(max_workers=PAGERS, thread_name_prefix='pager')
 
-    def get(self, endpoint, params={}) -> dict:
-        """Returns JSON from API call to specified endpoint"""
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, endpoint, params={}, fields=None) -> dict:
+        """Returns JSON from API call to specified endpoint, requesting each endpoint only once per run.
+        fields is a TeamCity fields= selector limiting the response to those attributes"""
+        if fields and 'fields=' not in endpoint:
+            params = {**params, 'fields': fields}
+
+        key = (endpoint.replace(self.BASE_URL, ""), tuple(sorted(params.items())))
+        with self.cache_lock:
+            future = self.cache.get(key)
+            if owner := future is None:
+                future = self.cache[key] = Future()
+
+        # concurrent callers of the same endpoint wait for the one request in flight
+        if not owner:
+            logging.debug(f'TeamCity API GET cached: {key[0]}')
+            return future.result()
+
+        try:
+            future.set_result(self._get(endpoint, params))
+        except Exception as e:
+            with self.cache_lock:
+                del self.cache[key]
+            future.set_exception(e)
+        return future.result()
+
+    def iter_pages(self, endpoint, params={}, key='build', fields=None):
+        """Yields items of a paged TeamCity collection, fetching the page at nextHref while the current one is consumed"""
+        page = self.pager.submit(self.get, endpoint, params, fields)
+        while page:
+            api_json = page.result()
+            page = (next_href := api_json.get('nextHref')) and self.pager.submit(self.get, next_href, {}, fields)
+            yield from api_json.get(key) or []
+
+    def _get(self, endpoint, params={}) -> dict:
+        """Returns JSON from API call to specified endpoint, revalidating the on-disk copy with its ETag"""
         logging.info(f'TeamCity API GET request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_json := requests.get(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        url = f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}'
+
+        cached, cache_file = None, None
+        if self.cache_dir:
+            cache_file = os.path.join(self.cache_dir, hashlib.sha256(f'{url}?{sorted(params.items())}'.encode('utf8')).hexdigest() + '.json')
+            if os.path.isfile(cache_file):
+                with open(cache_file) as f:
+                    cached = jsonlib.load(f)
+
+        response = self._send(
+            'get',
+            endpoint,
+            headers={'If-None-Match': cached.get('etag')} if cached else {},
             params=params
-        ).json()))
+        )
+
+        if cached and response.status_code == 304:
+            logging.debug(f'TeamCity API GET not modified: {endpoint.replace(self.BASE_URL, "")}')
+            return cached.get('json')
+
+        logging.debug(LazyFormat(api_json := response.json()))
+        if cache_file and response.ok and (etag := response.headers.get('ETag')):
+            with open(f'{cache_file}.tmp', 'w') as f:
+                jsonlib.dump({'etag': etag, 'json': api_json}, f)
+            os.replace(f'{cache_file}.tmp', cache_file)
         return api_json
 
     def post(self, endpoint, json={}) -> dict:
         """Returns JSON from API call to specified endpoint"""
         logging.info(f'TeamCity API POST request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_json := requests.post(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        logging.debug(LazyFormat(api_json := self._send(
+            'post',
+            endpoint,
             json=json
         ).json()))
         return api_json
@@ -104,29 +456,219 @@ class TeamCityApi:
     def put(self, endpoint, json={}) -> dict:
         """Returns JSON from API call to specified endpoint"""
         logging.info(f'TeamCity API PUT request: {endpoint.replace(self.BASE_URL, "")}')
-        logging.debug(pformat(api_json := requests.put(
-            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
-            headers={
-                'Accept': 'application/json',
-                'Authorization': self.authorization,
-            },
-            timeout=TIMEOUT,
+        logging.debug(LazyFormat(api_json := self._send(
+            'put',
+            endpoint,
             json=json
         ).json()))
         return api_json
 
-def main() -> int:
+    def _send(self, method, endpoint, **kwargs) -> requests.Response:
+        """Returns response of the request, recording its span when tracing"""
+        start = time.monotonic()
+        response = self.session.request(
+            method,
+            f'{self.BASE_URL}{endpoint.replace(self.BASE_URL, "")}',
+            timeout=TIMEOUT,
+            **kwargs
+        )
+        if self.tracer:
+            self.tracer.record('TeamCity', method, endpoint.replace(self.BASE_URL, ""), response, time.monotonic() - start)
+        return response
+
+def release_build(tc, bb, graph, build, release, delete=False, tag_writes=None, journal=None) -> dict:
+    """Submits the tasks releasing `build` as `release` to the graph, returns { tags endpoint: hash } filled in as they run.
+    Operations and lookups already recorded in the journal are not repeated."""
+    tag_writes = tag_writes or Once()
+    journal = journal or Journal()
+    bundle_locator = f'buildType:flight_sw__m000_eec_control_sw_controlwin,number:{build}'
+
+    def get_props() -> None:
+        if (bundle_props := journal.get('props')) is None:
+            logging.info(f'Getting build {build} metadata') # produces dict of { name: value } from properties
+            logging.debug(LazyFormat(bundle_props := dict(reduce(
+                lambda x, y: x.update({y.get('name'): y.get('value')}) or x,
+                tc.get(f'/app/rest/builds/{bundle_locator}/resulting-properties', fields=PROPERTIES_FIELDS).get('property')
+            ))))
+            journal.record('props', bundle_props)
+
+        logging.info('Determining unique build types in build') # produces set of { buildType }
+        logging.debug(LazyFormat(build_types := set(map(
+            lambda d: d.split('.')[1],
+            filter(
+                lambda p: re.search(r'^dep\..*\.system\.build\.(vcs\.)?number$', p),
+                bundle_props.keys()
+            )
+        ))))
+
+    def tag_build() -> None:
+        if journal.done('tag-build'):
+            return
+        logging.info(f'Tagging build {build} as release')
+        logging.debug(LazyFormat(bundle_tags := dict(tc.post(f'/app/rest/builds/{bundle_locator}/tags', json={'count': 1, 'tag': [{'name': 'release'}]}))))
+        journal.record('tag-build')
+
+    def dependency_builds(dependency):
+        """Yields hrefs of the bundle's artifactDependency or snapshotDependency builds"""
+        if (hrefs := journal.get(dependency)) is not None:
+            yield from hrefs
+            return
+
+        hrefs = []
+        for b in tc.iter_pages('/app/rest/builds', params={
+            'locator': f'{dependency}:(to:({bundle_locator}),includeInitial:true)'
+        }, fields=BUILDS_FIELDS):
+            hrefs.append(b.get('href'))
+            yield b.get('href')
+        journal.record(dependency, hrefs)
+
+    # request body for build pinning
+    pin_timestamp = datetime.now(timezone.utc).strftime("%%Y%%m%%dT%%H%%M%%S%%z")
+
+    # for each artifact dependency, pin the build with the release version as the comment
+    def pin_builds() -> None:
+        logging.info(f'Pinning build {build} and all artifact dependency builds')
+        for href in dependency_builds('artifactDependency'):
+            graph.submit(pin_build, f'{href}/pinInfo')
+
+    def pin_build(p) -> None:
+        if journal.done(op := f"{'unpin' if delete else 'pin'}:{p}"):
+            return
+        logging.debug(LazyFormat(tc.put(p, json={
+            'comment': {
+                'text': f'Release {release}',
+                'timestamp': pin_timestamp,
+            },
+            'status': not delete,
+        })))
+        journal.record(op, undo=f"{'pin' if delete else 'unpin'}:{p}")
+
+    # each snapshot dependency revision is resolved to a hash concurrently; the repositories are
+    # tagged once all of them are known, so a repository built at several revisions is always
+    # tagged at the last one in snapshot dependency order, whichever thread finishes first
+    vcs_hashes = {}
+    vcs_candidates = {} # {tags endpoint: {(build index, revision index): hash}}
+    vcs_hashes_lock = threading.Lock()
+    unresolved = 1 # the snapshot dependency listing itself
+
+    def expect(count) -> None:
+        nonlocal unresolved
+        with vcs_hashes_lock:
+            unresolved += count
+
+    def resolved() -> None:
+        nonlocal unresolved
+        with vcs_hashes_lock:
+            unresolved -= 1
+            if unresolved:
+                return
+            for v, candidates in vcs_candidates.items():
+                vcs_hashes[v] = candidates[max(candidates)]
+                if len(set(candidates.values())) > 1:
+                    logging.warning(f"{v} built at {', '.join(sorted(set(candidates.values())))}, tagging {vcs_hashes[v]}")
+
+        for v in vcs_hashes:
+            # another release in this run may already be writing the same tag
+            if tag_writes.first((v, release, vcs_hashes.get(v), delete)):
+                graph.submit(tag_repo, v)
+
+    def get_snapshot_builds() -> None:
+        logging.info(f'Getting latest revision for each snapshot dependency')
+        for index, href in enumerate(dependency_builds('snapshotDependency')):
+            expect(1)
+            graph.submit(get_revisions, index, href)
+        resolved()
+
+    def get_revisions(index, p) -> None:
+        if (revisions := journal.get(f'revisions:{p}')) is None:
+            revisions = list(filter(
+                lambda r: r.get('vcs-root-instance').get('vcs-root-id') != 'avionics_firmware',
+                tc.get(p, fields=REVISIONS_FIELDS).get('revisions').get('revision')
+            ))
+            journal.record(f'revisions:{p}', revisions)
+
+        expect(len(revisions))
+        for order, r in enumerate(revisions):
+            graph.submit(get_hash, (index, order), r)
+        resolved()
+
+    def get_hash(order, r) -> None:
+        if (v := journal.get(f"vcs:{r.get('vcs-root-instance').get('href')}")) is None:
+            logging.debug(f"Getting hash to tag as release for VCS root {r.get('vcs-root-instance').get('vcs-root-id')}")
+            v = re.sub(r'.*bitbucket\.org:(.*)/(.*)\.git', r'/2.0/repositories/\g<1>/\g<2>/refs/tags', {
+                p.get('name'): p.get('value')
+                for p in tc.get(r.get('vcs-root-instance').get('href'), fields=VCS_ROOT_FIELDS).get('properties').get('property')
+            }.get('url'))
+            journal.record(f"vcs:{r.get('vcs-root-instance').get('href')}", v)
+
+        with vcs_hashes_lock:
+            vcs_candidates.setdefault(v, {})[order] = r.get('version')
+        resolved()
+
+    def tag_repo(v) -> None:
+        if journal.done(op := f"{'untag' if delete else 'tag'}:{v}"):
+            logging.info(f'{v}/rel/{release} already {"deleted" if delete else "tagged"}')
+            return
+
+        # plan the write from the tags already in the repository
+        existing = {
+            t.get('name'): t.get('target', {}).get('hash', '')
+            for t in bb.iter_pages(v, params={'q': f'name="rel/{release}"', 'fields': 'next,values.name,values.target.hash'})
+        }.get(f'rel/{release}')
+        if existing is not None and not existing.startswith(vcs_hashes.get(v)):
+            # a tag of another commit is neither moved nor deleted
+            raise RuntimeError(f'{v}/rel/{release}: conflict, tag is at {existing} instead of {vcs_hashes.get(v)}')
+        if (existing is None) == delete:
+            logging.info(f'{v}/rel/{release}: skip, already {"absent" if delete else "at " + existing}')
+            journal.record(op, vcs_hashes.get(v), undo=f"{'tag' if delete else 'untag'}:{v}")
+            return
+
+        logging.info(f'{v}/rel/{release}: {"delete" if delete else "create"}')
+        if delete:
+            logging.info(LazyFormat(tag_response := bb.delete(f'{v}/rel/{release}')))
+        else:
+            logging.info(LazyFormat(tag_response := bb.post(v, json={
+                'name': f'rel/{release}',
+                'target': {
+                    'hash': vcs_hashes.get(v)
+                },
+            })))
+        journal.record(op, vcs_hashes.get(v), undo=f"{'tag' if delete else 'untag'}:{v}")
+
+    logging.info(f'Releasing build {build} as rel/{release}')
+    for task in (get_props, tag_build, pin_builds, get_snapshot_builds):
+        graph.submit(task)
+    return vcs_hashes
+
+def main(argv=None) -> int:
     # set up argument parsing
     parser = argparse.ArgumentParser(description='Generate changelog between two build numbers')
     parser.add_argument('-q', '--quiet', action='count', default=0, help='Decrease logging verbosity')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='Increase logging verbosity')
-    parser.add_argument('--build', required=True, help='Build number to be released')
-    parser.add_argument('--release', required=True, help='Version number for this release; consult Software Plans doc')
+    parser.add_argument('--build', help='Build number to be released')
+    parser.add_argument('--release', help='Version number for this release; consult Software Plans doc')
+    parser.add_argument('--releases', nargs='+', default=[], metavar='BUILD=RELEASE', help='Several build/release pairs to release at once')
     parser.add_argument('--bb-username', required=True, help='BitBucket app username', dest='username')
     parser.add_argument('--bb-password', required=True, help='BitBucket app password', dest='password')
     parser.add_argument('--tc-token', required=True, help='TeamCity bearer token', dest='token')
     parser.add_argument('--delete', default=False, action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=WORKERS, help='Number of worker threads and pooled connections per API')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='Retries on connection errors and 5xx responses')
+    parser.add_argument('--backoff', type=float, default=BACKOFF, help='Backoff factor in seconds between retries')
+    parser.add_argument('--tc-url', default=None, help=f'TeamCity server, {TeamCityApi.BASE_URL} by default')
+    parser.add_argument('--bb-url', default=None, help=f'BitBucket API server, {BitBucketApi.BASE_URL} by default')
+    parser.add_argument('--trace', default=False, action='store_true', help='Print slowest endpoints and latency histogram of the API requests at exit')
+    parser.add_argument('--journal-dir', default=None, help='Directory to keep release-<build>-<release>.jsonl journals in, so a failed run can be resumed')
+    parser.add_argument('--tc-cache-dir', default=None, help='Directory to keep TeamCity responses in, revalidated with ETags', dest='cache_dir')
+    args = parser.parse_args(argv)
+
+    if bool(args.build) != bool(args.release):
+        parser.error('--build and --release go together')
+    if not args.build and not args.releases:
+        parser.error('either --build and --release or --releases is required')
+    if any('=' not in pair for pair in args.releases):
+        parser.error('--releases takes BUILD=RELEASE pairs')
+    args.releases = ([(args.build, args.release)] if args.build else []) + [tuple(pair.split('=', 1)) for pair in args.releases]
 
     # translate verbosity flag count to logging level
     loglevel = logging.INFO - ((10 * args.verbose) if args.verbose > 0 else 0) + ((10 * args.quiet) if args.quiet > 0 else 0)
@@ -135,7 +677,7 @@ def main() -> int:
         level=loglevel,
         format='%(levelname)s: %(message)s',
     )
-    logging.debug(pformat(vars(args)))
+    logging.debug(LazyFormat(vars(args)))
 
     if loglevel <= logging.DEBUG:
         http_client.HTTPConnection.debuglevel = 1
@@ -145,97 +687,32 @@ def main() -> int:
         logging.debug('Enabled HTTP debug output')
 
     # not getting fucked by GIL using threads instead of processes since we'll be network I/O bound
-    logging.debug('Setting up thread pool with default 5x logical cores')
-    executor = ThreadPoolExecutor()
+    logging.debug(f'Setting up thread pool with {args.workers} workers')
+    executor = ThreadPoolExecutor(max_workers=args.workers)
 
     logging.info('Initializing API classes')
-    tc = TeamCityApi(**vars(args))
-    bb = BitBucketApi(**vars(args))
-
-    logging.info(f'Getting build {args.build} metadata') # produces dict of { name: value } from properties
-    logging.debug(pformat(bundle_props := dict(reduce(
-        lambda x, y: x.update({y.get('name'): y.get('value')}) or x,
-        tc.get(f'/app/rest/builds/buildType:flight_sw__m000_eec_control_sw_controlwin,number:{args.build}/resulting-properties').get('property')
-    ))))
-
-    logging.info(f'Tagging build {args.build} as release')
-    logging.debug(pformat(bundle_tags := dict(tc.post(f'/app/rest/builds/buildType:flight_sw__m000_eec_control_sw_controlwin,number:{args.build}/tags', json={'count': 1, 'tag': [{'name': 'release'}]}))))
-
-    logging.info('Determining unique build types in build') # produces set of { buildType }
-    logging.debug(pformat(build_types := set(map(
-        lambda d: d.split('.')[1],
-        filter(
-            lambda p: re.search(r'^dep\..*\.system\.build\.(vcs\.)?number$', p),
-            bundle_props.keys()
-        )
-    ))))
+    tracer = Tracer() if args.trace else None
+    tc = TeamCityApi(tracer=tracer, **vars(args))
+    bb = BitBucketApi(tracer=tracer, **vars(args))
 
-    # request body for build pinning
-    pin_timestamp = datetime.now(timezone.utc).strftime("%%Y%%m%%dT%%H%%M%%S%%z")
+    if args.journal_dir:
+        os.makedirs(args.journal_dir, exist_ok=True)
 
-    # for each artifact dependency, pin the build with the release version as the comment
-    logging.info(f'Pinning build {args.build} and all artifact dependency builds')
-    logging.debug(pformat(list(executor.map(
-        lambda p: tc.put(p, json={
-            'comment': {
-                'text': f'Release {args.release}',
-                'timestamp': pin_timestamp,
-            },
-            'status': not args.delete,
-        }),
-        map(
-            lambda b: f"{b.get('href')}/pinInfo",
-            tc.get('/app/rest/builds', params={
-                'locator': f'artifactDependency:(to:(buildType:flight_sw__m000_eec_control_sw_controlwin,number:{args.build}),includeInitial:true)'
-            }).get('build')
-        )
-    ))))
-
-    logging.info(f'Getting latest revision for each snapshot dependency')
-    logging.debug(pformat(bundle_revs := filter(
-        lambda r: r.get('vcs-root-instance').get('vcs-root-id') != 'avionics_firmware',
-        chain(*executor.map(
-            lambda p: tc.get(p).get('revisions').get('revision'),
-            [
-                b.get('href')
-                for b in tc.get('/app/rest/builds', params={
-                    'locator': f'snapshotDependency:(to:(buildType:flight_sw__m000_eec_control_sw_controlwin,number:{args.build}),includeInitial:true)'
-                }).get('build')
-            ]
-        ))))
-    )
+    graph = TaskGraph(executor)
+    tag_writes = Once()
+    releases = {
+        (build, release): release_build(tc, bb, graph, build, release, args.delete, tag_writes,
+                                        Journal(args.journal_dir and os.path.join(args.journal_dir, f'release-{build}-{release}.jsonl')))
+        for build, release in args.releases
+    }
+    graph.wait()
 
-    logging.info('Getting hash to tag as release for each VCS')
-    logging.debug(pformat(vcs_hashes := reduce(
-        lambda x, y: x.update(y) or x,
-        executor.map(
-            lambda r: {
-                re.sub(r'.*bitbucket\.org:(.*)/(.*)\.git', r'/2.0/repositories/\g<1>/\g<2>/refs/tags', {
-                    p.get('name'): p.get('value')
-                    for p in tc.get(r.get('vcs-root-instance').get('href')).get('properties').get('property')
-                }.get('url')):
-                r.get('version')
-            },
-            bundle_revs
-        )
-    )))
+    if tracer:
+        print(tracer.summary(), file=sys.stderr)
 
-    logging.info(f'Tagging release as rel/{args.release}')
-    if args.delete:
-        logging.info(pformat(tag_response := list(executor.map(
-            lambda v: bb.delete(f'{v}/rel/{args.release}'),
-            vcs_hashes.keys()
-        ))))
-    else:
-        logging.info(pformat(tag_response := list(executor.map(
-            lambda v: bb.post(v, json={
-                'name': f'rel/{args.release}',
-                'target': {
-                    'hash': vcs_hashes.get(v)
-                },
-            }),
-            vcs_hashes.keys()
-        ))))
+    logging.debug(LazyFormat(releases))
+    logging.info(f'BitBucket throttled {bb.limiter.throttled} requests')
+    return 1 if graph.errors else 0
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -10,21 +10,59 @@
         -V, --version: Print the version of the script.
         -v, --verbose: Generate verbose output.
         -c, --command: Command to run on RACADM
+        -k, --keep-alive: Reuse one SSH session per remote system.
+        -i, --idle-timeout: Seconds before an unused SSH session is closed.
+        -f, --hosts-file: File with the list of systems to run the command on.
+        -w, --workers: Number of systems to talk to at the same time.
+        -t, --timeout: Seconds to wait for the command on each system.
+        -b, --batch-file: File with the list of commands to run, '-' for stdin.
+        -e, --stop-on-error: Stop the batch at the first failed command.
+        -T, --timings-file: File to export the per-phase timings to.
+        -F, --timings-format: Format of the timings file, 'json' lines or 'prom' textfile.
+        -C, --inventory-file: Inventory snapshot file, inventory commands are answered from it.
+        -I, --invalidate: Drop the cached inventory of the systems before running the command.
 
 """
 
 import os
+import collections
+import json
+import math
 import pexpect
 import re
 import syslog
 import time
 import subprocess
+import sys
+import threading
+import Queue
 
 import optparse
 
 ###############################################################################
 VER_STRING                  = "0.1"
 VM_PAT_LINUX_PROMPT         = re.compile(r'(?!^\s)^.*[#\$]$|(?!^\s)^.*[#\$]\s$|(?!^\s)^[#\$]\s$|(?!^\s)\[.*\][#\$]|\[.+@.+\][#\$]|/.+->\s',re.M)
+SSH_OPTIONS                 = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
+SESSION_IDLE_TIMEOUT        = 300
+COMMAND_TIMEOUT             = 120
+# Only the tail of the session output is searched for the prompt, the whole
+# buffer would be searched again on every read
+EXPECT_WINDOW               = 2000
+# The session shell prints the exit status of every command after this marker
+SESSION_RC_MARKER           = 'RACADM_RC='
+SESSION_RC_PAT              = re.compile(r'^%s(\d+)\s*$' % SESSION_RC_MARKER)
+CONNECT_TIMEOUT             = 60
+CONNECT_TIMEOUT_MIN         = 5
+FAN_OUT_WORKERS             = 16
+CLEAN_FILE_BUFFER           = 64 * 1024
+CLEAN_FILE_FLUSH_INTERVAL   = 1.0
+# All the control characters except the new line
+CONTROL_CHARS               = ''.join(chr(c) for c in range(32) if c != 10)
+INVENTORY_TTL               = 3600
+CAPTURE_MAX_LINES           = 10000
+TIMING_PHASES               = ('spawn', 'handshake', 'auth', 'command', 'teardown')
+RACADM_PAT_SECTION          = re.compile(r'^\[InstanceID:\s*(.+)\]$|^([^=]+):$')
+RACADM_PAT_KEY_VALUE        = re.compile(r'^([^=]+?)\s*=\s*(.*)$')
 
 ###############################################################################
 def filterPick(lines, regex_str):
@@ -34,6 +72,48 @@ def filterPick(lines, regex_str):
     regex = re.compile(r'%s' % regex_str)
     return [i for i in lines if not regex.match(i)]
 
+###############################################################################
+def parse_key_values(output):
+    """
+    Parse 'key = value' lines of the RACADM output into a dictionary
+    """
+    data = {}
+    for line in output.splitlines():
+        matchObj = RACADM_PAT_KEY_VALUE.match(line.strip())
+        if (matchObj != None):
+            data[' '.join(matchObj.group(1).split())] = matchObj.group(2)
+    return data
+
+def parse_sections(output):
+    """
+    Parse the RACADM output split into sections into a dictionary of dictionaries.
+    Sections are either 'Title:' lines (getsysinfo) or '[InstanceID: ...]' lines (hwinventory).
+    The values before the first section go into the '' section.
+    """
+    data = {}
+    section = data.setdefault('', {})
+    for line in output.splitlines():
+        line = line.strip()
+
+        matchObj = RACADM_PAT_KEY_VALUE.match(line)
+        if (matchObj != None):
+            section[' '.join(matchObj.group(1).split())] = matchObj.group(2)
+            continue
+
+        matchObj = RACADM_PAT_SECTION.match(line)
+        if (matchObj != None):
+            section = data.setdefault((matchObj.group(1) or matchObj.group(2)).strip(), {})
+
+    if (len(data['']) == 0):
+        del data['']
+    return data
+
+INVENTORY_PARSERS = {
+    'getversion':   parse_key_values,
+    'getsysinfo':   parse_sections,
+    'hwinventory':  parse_sections,
+}
+
 ###############################################################################
 class CaptureResult( object ):
     """class returned by function subprocess_capture() which is a wrapper around Popen"""
@@ -61,30 +141,559 @@ def subprocess_capture(command, shell=False):
     result = subproc.communicate()
     return CaptureResult(result[0], result[1], subproc.returncode)
 
+def line_filter(regex_str):
+    """
+    Return a line callback which drops the lines matching the regex string,
+    the streaming counterpart of filterPick()
+    """
+    regex = re.compile(r'%s' % regex_str)
+    return lambda line: None if regex.match(line) else line
+
+class StreamCapture(object):
+    """
+    Streaming counterpart of subprocess_capture(). Iterating over the object runs
+    the subprocess and yields ('out' or 'err', line) tuples as the lines arrive.
+    Every callback gets the line and returns the line to pass on or None to drop it.
+    Only the last max_lines lines of each stream are kept in out and err.
+    """
+
+    def __init__(self, command, shell=False, max_lines=CAPTURE_MAX_LINES, callbacks=()):
+        self.command = command
+        self.shell = shell
+        self.callbacks = callbacks
+        self.out = collections.deque(maxlen=max_lines)
+        self.err = collections.deque(maxlen=max_lines)
+        self.returncode = None
+
+    def __iter__(self):
+        subproc = subprocess.Popen(
+            self.command, shell=self.shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # Bounded, so the readers wait for a slow consumer instead of piling up lines
+        lines = Queue.Queue(maxsize=1024)
+        stopped = threading.Event()
+
+        def reader(name, pipe):
+            for line in iter(pipe.readline, ''):
+                if (not stopped.is_set()):
+                    lines.put((name, line))
+            pipe.close()
+            if (not stopped.is_set()):
+                lines.put((name, None))
+
+        readers = [threading.Thread(target=reader, args=('out', subproc.stdout)),
+                   threading.Thread(target=reader, args=('err', subproc.stderr))]
+        for thread in readers:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            running = len(readers)
+            while (running > 0):
+                name, line = lines.get()
+                if (line == None):
+                    running -= 1
+                    continue
+
+                for callback in self.callbacks:
+                    line = callback(line)
+                    if (line == None):
+                        break
+                if (line == None):
+                    continue
+
+                getattr(self, name).append(line)
+                yield (name, line)
+
+            self.returncode = subproc.wait()
+        finally:
+            if (self.returncode == None):
+                # The consumer stopped early, kill the subprocess and unblock the readers
+                stopped.set()
+                if (subproc.poll() == None):
+                    subproc.kill()
+                deadline = time.time() + 1.0
+                while (time.time() < deadline and any(thread.is_alive() for thread in readers)):
+                    try:
+                        lines.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+                self.returncode = subproc.wait()
+
+    def __nonzero__(self):
+        """ True means good/success (i.e., 0). """
+        return self.returncode == 0
+
+def subprocess_capture_stream(command, shell=False, max_lines=CAPTURE_MAX_LINES, callbacks=()):
+    """Execute a subprocess keeping only the last max_lines lines of its output.
+       Returns a CaptureResult object of stdout, stderr, and returncode
+    """
+    capture = StreamCapture(command, shell, max_lines, callbacks)
+    for name, line in capture:
+        pass
+
+    return CaptureResult(''.join(capture.out), ''.join(capture.err), capture.returncode)
+
+###############################################################################
+class PhaseTimer(object):
+    """
+    Records how long each phase of a RACADM command took, in seconds
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.last = time.time()
+
+    def mark(self, phase):
+        """
+        Close the phase which started at the previous mark
+        """
+        now = time.time()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self.last
+        self.last = now
+
+class RacAdmOutput(str):
+    """
+    Output of a RACADM command. Behaves as a string, the per-phase timings are in 'timings'.
+    """
+
+    def __new__(cls, output, timings):
+        obj = str.__new__(cls, output)
+        obj.timings = timings
+        return obj
+
+def percentile(values, pct):
+    """
+    Return the nearest rank percentile of the values
+    """
+    values = sorted(values)
+    if (len(values) == 0):
+        return 0.0
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
 ###############################################################################
 class CleanFile(file):
     """
-    Subclass of file object to avoid recording extensive whitespace characters
+    Subclass of file object to avoid recording extensive whitespace characters.
+    The cleaned text is kept in memory and written out in large blocks.
+    pending overlays the file from the real file pointer on, cursor is the
+    write position inside it.
     """
+    def __init__(self, *args, **kwargs):
+        file.__init__(self, *args, **kwargs)
+        self.pending = bytearray()
+        self.cursor = 0
+
     def write(self, text):
-        # Remove the whitespaces
-        out_text = ''
-        # process the backspace properly
-        bline = ''
-        for c in text:
-            if (ord(c) == 0x8):
-                if (len(bline) == 0):
-                    # Move the file pointer.
-                    file.seek(self, -1, os.SEEK_CUR)
-                else:
-                    bline = bline[:-1]
+        # process the backspace properly, counting the ones that erase already written text
+        bline = bytearray()
+        erase = 0
+        pieces = text.split('\x08')
+        bline.extend(pieces[0])
+        for piece in pieces[1:]:
+            if (len(bline) == 0):
+                erase += 1
+            else:
+                del bline[-1]
+            bline.extend(piece)
+
+        if (erase > self.cursor):
+            # Move the file pointer back in front of the buffered text.
+            erase -= self.cursor
+            self.cursor = 0
+            self.drain()
+            file.seek(self, -erase, os.SEEK_CUR)
+        else:
+            self.cursor -= erase
+
+        # remove whitespaces from inside a line, overwriting the text after the cursor
+        bline = bline.translate(None, CONTROL_CHARS)
+        self.pending[self.cursor:self.cursor + len(bline)] = bline
+        self.cursor += len(bline)
+
+        if (len(self.pending) >= CLEAN_FILE_BUFFER):
+            self.drain()
+
+    def drain(self):
+        """
+        Write out the buffered text, leaving the file pointer at the cursor
+        """
+        if (len(self.pending) > 0):
+            file.write(self, str(self.pending))
+            if (self.cursor < len(self.pending)):
+                file.seek(self, self.cursor - len(self.pending), os.SEEK_CUR)
+            del self.pending[:]
+            self.cursor = 0
+
+    def flush(self):
+        self.drain()
+        file.flush(self)
+
+    def close(self):
+        self.drain()
+        file.close(self)
+
+    def __del__(self):
+        # file dealloc doesn't call close(), don't lose the buffered tail
+        if (not self.closed):
+            self.drain()
+
+class PexpectLog(object):
+    """
+    Log file for pexpect. pexpect flushes after every read, so the log is only
+    flushed once in a while.
+    """
+    def __init__(self, fout):
+        self.fout = fout
+        self.flushed = time.time()
+
+    def write(self, text):
+        self.fout.write(text)
+
+    def flush(self):
+        if ((time.time() - self.flushed) >= CLEAN_FILE_FLUSH_INTERVAL):
+            self.fout.flush()
+            self.flushed = time.time()
+
+def pexpect_log(fout):
+    """
+    Return the pexpect log file for the log file, None if there is no log
+    """
+    if (fout == None):
+        return None
+    return PexpectLog(fout)
+
+###############################################################################
+class ConnectTimeout(object):
+    """
+    Per-system timeout for the SSH handshake learned from the observed latency.
+    Keeps a smoothed latency and its deviation the same way TCP sets its
+    retransmit timer, so a fast system fails fast and a slow one is given more time.
+    """
+
+    def __init__(self, default=CONNECT_TIMEOUT, minimum=CONNECT_TIMEOUT_MIN):
+        self.default = default
+        self.minimum = minimum
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get(self, system):
+        """
+        Return the timeout to use for the next handshake with the system
+        """
+        with self.lock:
+            if (system not in self.stats):
+                return self.default
+            srtt, rttvar = self.stats[system]
+
+        return min(self.default, max(self.minimum, srtt + 4 * rttvar))
+
+    def update(self, system, latency):
+        """
+        Record the latency of a successful handshake
+        """
+        with self.lock:
+            if (system not in self.stats):
+                self.stats[system] = (latency, latency / 2)
             else:
-                bline += c
+                srtt, rttvar = self.stats[system]
+                rttvar = 0.75 * rttvar + 0.25 * abs(srtt - latency)
+                srtt = 0.875 * srtt + 0.125 * latency
+                self.stats[system] = (srtt, rttvar)
+
+    def expire(self, system):
+        """
+        Forget what was learned after a handshake timed out
+        """
+        with self.lock:
+            self.stats.pop(system, None)
+
+connect_timeouts = ConnectTimeout()
+
+###############################################################################
+class RacAdmSession(object):
+    """
+    One authenticated interactive SSH connection to a remote RACADM.
+    Commands are sent down the open shell instead of spawning ssh every time.
+    """
+
+    def __init__(self, rac_system, rac_system_user, rac_system_passwd, file_log_out=None):
+        self.system = rac_system
+        self.user = rac_system_user
+        self.user_passwd = rac_system_passwd
+        self.fout = file_log_out
+        self.p = None
+        self.last_used = 0
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def open(self, timeout=CONNECT_TIMEOUT, timer=None):
+        """
+        Spawn the ssh shell, answer the password prompt and wait for the shell prompt
+        """
+        if (timer == None):
+            timer = PhaseTimer()
+
+        # In order to prevent some extra window popping up asking for password,
+        # clear the two terminal variables. Check the SSH man page for the reason
+        os.environ["SSH_ASKPASS"] = ''
+        os.environ["DISPLAY"] = ''
+
+        self.p = pexpect.spawn ("ssh %s %s@%s" % (SSH_OPTIONS, self.user, self.system))
+        self.p.setecho(True)
+        self.p.logfile_read = pexpect_log(self.fout)
+        timer.mark('spawn')
+
+        start = time.time()
+        i = self.p.expect (["%s@%s's password:" % (self.user, self.system), VM_PAT_LINUX_PROMPT, pexpect.EOF, pexpect.TIMEOUT],
+                           timeout=connect_timeouts.get(self.system), searchwindowsize=EXPECT_WINDOW)
+        if (i == 3):
+            connect_timeouts.expire(self.system)
+        elif (i != 2):
+            connect_timeouts.update(self.system, time.time() - start)
+        timer.mark('handshake')
+
+        if (i == 0):
+            self.p.send(self.user_passwd + '\n')
+            i = self.p.expect ([VM_PAT_LINUX_PROMPT, pexpect.EOF, pexpect.TIMEOUT, 'Permission denied'],
+                               timeout=timeout, searchwindowsize=EXPECT_WINDOW) + 1
+            timer.mark('auth')
+
+        if (i != 1):
+            self.close()
+            raise Exception ("Error opening session to %s@%s [%d]" % (self.user, self.system, i))
+
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """
+        Return flag indicating if the ssh shell is still usable
+        """
+        return (self.p != None and self.p.isalive())
+
+    def run(self, command, timeout=COMMAND_TIMEOUT):
+        """
+        Run a single racadm command in the open shell.
+        Returns the output and the exit status, None if it could not be read.
+        """
+        full_command = 'racadm %s' % command
 
-        # remove whitespaces from inside a line
-        out_text += ''.join(c for c in bline if (ord(c) >= 32 or ord(c) == 10))
+        with self.lock:
+            self.p.sendline('%s; echo %s$?' % (full_command, SESSION_RC_MARKER))
+            j = self.p.expect ([VM_PAT_LINUX_PROMPT, pexpect.EOF, pexpect.TIMEOUT], timeout=timeout, searchwindowsize=EXPECT_WINDOW)
+            self.last_used = time.time()
+            if (j != 0):
+                self.close()
+                raise Exception ("Error running command '%s' on system %s@%s [%d]" % (full_command, self.user, self.system, j))
 
-        file.write(self, out_text)
+            output = self.p.before
+
+        # RACADM reports a failure in the output, same as the 'Error' pattern of the one-shot paths
+        if ('Error' in output):
+            raise Exception ("Error running command '%s' on system %s@%s" % (full_command, self.user, self.system))
+
+        output_lines = output.splitlines()
+
+        # The shell echoes the command back first
+        if (len(output_lines) > 0 and full_command in output_lines[0]):
+            output_lines = output_lines[1:]
+
+        returncode = None
+        if (len(output_lines) > 0):
+            match = SESSION_RC_PAT.match(output_lines[-1].strip())
+            if (match != None):
+                returncode = int(match.group(1))
+                output_lines = output_lines[:-1]
+
+        return ("\n".join(output_lines), returncode)
+
+    def close(self):
+        if (self.p != None):
+            try:
+                self.p.sendline('exit')
+            except Exception:
+                pass
+            self.p.close()
+            self.p = None
+
+###############################################################################
+class RacAdmSessionPool(object):
+    """
+    Keeps one RacAdmSession per (user, system) and closes the ones that were
+    not used for longer than the idle timeout. A background reaper closes
+    them even if the pool isn't used any more.
+    """
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.stopped = threading.Event()
+
+    def acquire(self, rac_system, rac_system_user, rac_system_passwd, file_log_out=None, timer=None):
+        """
+        Return an open session for the system, creating it if needed.
+        The session is in use until it's handed back with release().
+        """
+        self.reap()
+
+        key = (rac_system_user, rac_system)
+        with self.lock:
+            session = self.sessions.get(key)
+            if (session == None or not session.is_alive()):
+                session = RacAdmSession(rac_system, rac_system_user, rac_system_passwd, file_log_out)
+                self.sessions[key] = session
+            session.in_use += 1
+
+            if (self.reaper == None):
+                self.stopped.clear()
+                self.reaper = threading.Thread(target=self.reap_idle)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+        try:
+            with session.lock:
+                if (not session.is_alive()):
+                    session.open(timer=timer)
+        except:
+            self.release(session)
+            raise
+
+        return session
+
+    def release(self, session):
+        """
+        Hand back the session returned by acquire()
+        """
+        with self.lock:
+            session.in_use -= 1
+            session.last_used = time.time()
+
+    def reap_idle(self):
+        """
+        Reaper thread, checks for the idle sessions until the pool is closed
+        """
+        while (not self.stopped.wait(max(1.0, self.idle_timeout / 2.0))):
+            self.reap()
+
+    def reap(self):
+        """
+        Close the sessions which were idle for too long
+        """
+        now = time.time()
+        with self.lock:
+            for key, session in self.sessions.items():
+                # Skip the sessions which were handed out or are in the middle of a command
+                if (session.in_use == 0 and (now - session.last_used) > self.idle_timeout):
+                    if (session.lock.acquire(False)):
+                        session.close()
+                        session.lock.release()
+                        del self.sessions[key]
+
+    def close_all(self):
+        self.stopped.set()
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            self.reaper = None
+
+###############################################################################
+class InventoryCache(object):
+    """
+    Cache of the parsed RACADM output per system. Entries expire after the TTL.
+    If the file name is given the cache is loaded from and saved to that file.
+    """
+
+    def __init__(self, ttl=INVENTORY_TTL, file_name=None):
+        self.ttl = ttl
+        self.file_name = None
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if (file_name != None):
+            self.load(file_name)
+
+    def load(self, file_name):
+        """
+        Load the cache from the file and save it there from now on.
+        A missing, corrupt or half written file means an empty cache.
+        """
+        entries = {}
+        if (os.path.isfile(file_name)):
+            try:
+                with open(file_name) as cache_file:
+                    entries = json.load(cache_file)
+            except (IOError, ValueError), e:
+                print ("Ignoring inventory snapshot '%s': %s" % (file_name, e))
+            if (not isinstance(entries, dict)):
+                entries = {}
+
+        with self.lock:
+            self.file_name = file_name
+            self.entries = entries
+
+    def get(self, system, command):
+        """
+        Return the cached data or None if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(system, {}).get(command)
+        if (entry == None or (time.time() - entry[0]) > self.ttl):
+            return None
+        return entry[1]
+
+    def put(self, system, command, data):
+        with self.lock:
+            self.entries.setdefault(system, {})[command] = [time.time(), data]
+        self.save()
+
+    def invalidate(self, system=None, command=None):
+        """
+        Drop the cached data for the command, the system or everything
+        """
+        with self.lock:
+            if (system == None):
+                self.entries.clear()
+            elif (command == None):
+                self.entries.pop(system, None)
+            else:
+                self.entries.get(system, {}).pop(command, None)
+        self.save()
+
+    def save(self):
+        """
+        Write the snapshot of the cache to the file
+        """
+        if (self.file_name == None):
+            return
+
+        with self.lock:
+            tmp_name = "%s.tmp" % self.file_name
+            with open(tmp_name, 'w') as cache_file:
+                json.dump(self.entries, cache_file)
+            os.rename(tmp_name, self.file_name)
+
+# Inventory cache shared by all the RacAdm objects
+inventories = InventoryCache()
+
+###############################################################################
+class CommandResult(object):
+    """Result of running one RACADM command on one of the systems"""
+
+    def __init__(self, host, command, error, output, elapsed, returncode=None):
+        self.host = host
+        self.command = command
+        self.error = error
+        self.output = output
+        self.elapsed = elapsed
+        self.returncode = returncode
+        self.timings = getattr(output, 'timings', {})
+
+    def __nonzero__(self):
+        """ True means good/success. """
+        return self.error == '' and self.returncode in (0, None)
 
 ###############################################################################
 class RacAdm(object):
@@ -94,13 +703,24 @@ class RacAdm(object):
     def __init__(self, rac_system='',
                  rac_system_user='',
                  rac_system_passwd='',
-                 file_log_out=None):
-        self.system = rac_system
-        self.user = rac_system_user
+                 file_log_out=None,
+                 session_pool=None,
+                 timeout=COMMAND_TIMEOUT,
+                 inventory_cache=None):
+        self._system = rac_system
+        self._user = rac_system_user
         self.user_passwd = rac_system_passwd
         self.local = False
-        self.error = ""
+        self._error = ""
+        self._returncode = None
         self.fout = file_log_out
+        self.pool = session_pool
+        self.timeout = timeout
+        self.cache = inventory_cache
+        self.timings = {}
+
+        if (inventory_cache == None):
+            self.cache = inventories
 
         if (rac_system == ''):
             self.local = True
@@ -108,23 +728,110 @@ class RacAdm(object):
     @property
     def system(self):
         """System to connect to. Empty if local"""
-        return self.system
+        return self._system
 
     @property
     def user(self):
         """Username for the system to connect to. Empty if local"""
-        return self.user
+        return self._user
 
     @property
     def error(self):
         """Return error string """
-        return self.error
+        return self._error
+
+    @property
+    def returncode(self):
+        """Exit status of the last command, None if it is not known"""
+        return self._returncode
 
     def get_version(self):
         """
         Return the RACADM version information
         """
-        return self.__execute_cmd__('racadm getversion')
+        return self.__execute_cmd__('getversion')
+
+    def get_inventory(self, command, refresh=False):
+        """
+        Return the parsed output of the inventory command ('getversion', 'getsysinfo'
+        or 'hwinventory'). The result is cached, refresh forces a new query.
+        """
+        data = None
+        if (not refresh):
+            data = self.cache.get(self.system, command)
+
+        if (data == None):
+            output = self.__execute_cmd__(command)
+            if (self.is_error()):
+                return {}
+
+            data = INVENTORY_PARSERS[command](output)
+            self.cache.put(self.system, command, data)
+
+        return data
+
+    def get_version_info(self, refresh=False):
+        """
+        Return the dictionary of the firmware versions
+        """
+        return self.get_inventory('getversion', refresh)
+
+    def get_sysinfo(self, refresh=False):
+        """
+        Return the dictionary of the system information sections
+        """
+        return self.get_inventory('getsysinfo', refresh)
+
+    def get_hwinventory(self, refresh=False):
+        """
+        Return the dictionary of the hardware inventory by the InstanceID
+        """
+        return self.get_inventory('hwinventory', refresh)
+
+    def invalidate(self, command=None):
+        """
+        Drop the cached inventory of this system
+        """
+        self.cache.invalidate(self.system, command)
+
+    def get_output(self, command, inventory=False):
+        """
+        Return the output of the command. With inventory the inventory commands
+        are answered from the inventory cache and their parsed output is JSON.
+        """
+        if (inventory and command in INVENTORY_PARSERS):
+            self._error = ''
+            data = self.get_inventory(command)
+            if (self.is_error()):
+                return ""
+            return json.dumps(data, indent=2, sort_keys=True)
+
+        return self.__execute_cmd__(command)
+
+    def run_batch(self, commands, stop_on_error=False):
+        """
+        Run the commands one after another. A remote system is talked to over
+        one SSH session. Returns the list of CommandResult objects.
+        """
+        pool = None
+        if (not self.local and self.pool == None):
+            pool = self.pool = RacAdmSessionPool()
+
+        results = []
+        try:
+            for command in commands:
+                start = time.time()
+                output = self.__execute_cmd__(command)
+                results.append(CommandResult(self.system, command, self.error, output, time.time() - start, self.returncode))
+
+                if (stop_on_error and self.is_error()):
+                    break
+        finally:
+            if (pool != None):
+                pool.close_all()
+                self.pool = None
+
+        return results
 
     def is_error(self):
         """
@@ -140,44 +847,79 @@ class RacAdm(object):
         '''
         output = ""
         full_command = 'racadm %s' % command
-        self.error = ''
+        self._error = ''
+        self._returncode = None
+        p = None
+        timer = PhaseTimer()
 
         try:
 
             if (self.local):
-                p = pexpect.spawn ("racadm %s'" % (command))
+                p = pexpect.spawn ("racadm %s" % (command))
                 p.setecho(True)
-                p.logfile_read = self.fout
+                p.logfile_read = pexpect_log(self.fout)
+                timer.mark('spawn')
 
-                j = p.expect ([pexpect.EOF, pexpect.TIMEOUT, 'Error'], timeout=120)
+                j = p.expect ([pexpect.EOF, pexpect.TIMEOUT, 'Error'], timeout=self.timeout, searchwindowsize=EXPECT_WINDOW)
                 if (j != 0):
                     raise Exception ("Error running command '%s' [%d]" % (full_command, j))
 
                 output = p.before
+                timer.mark('command')
+                self.__check_exit__(p, full_command)
 
             else:
-                # In order to prevent some extra window popping up asking for password,
-                # clear the two terminal variables. Check the SSH man page for the reason
-                os.environ["SSH_ASKPASS"] = ''
-                os.environ["DISPLAY"] = ''
+                if (self.pool != None):
+                    session = self.pool.acquire(self.system, self.user, self.user_passwd, self.fout, timer)
+                    try:
+                        (output, self._returncode) = session.run(command, self.timeout)
+                    finally:
+                        self.pool.release(session)
+                    timer.mark('command')
 
-                p = pexpect.spawn ("ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %s@%s 'racadm %s'" %
-                                    (self.user, self.system, command))
-                p.setecho(True)
-                p.logfile_read = self.fout
-                time.sleep (30)
+                    if (self._returncode not in (0, None)):
+                        raise Exception ("Error running command '%s' on system %s@%s [%s]" % (full_command, self.user, self.system, self._returncode))
 
-                i = p.expect (["%s@%s's password:" % (self.user, self.system), pexpect.EOF, pexpect.TIMEOUT, 'Error'], timeout=60)
-                if (i == 0):
-                    p.send(self.user_passwd + '\n')
-                    j = p.expect ([pexpect.EOF, pexpect.TIMEOUT, 'Error'], timeout=120)
-                    if (j != 0):
-                        raise Exception ("Error running command '%s' on system %s@%s [%d]" % (full_command, self.user, self.system, j))
+                else:
+                    # In order to prevent some extra window popping up asking for password,
+                    # clear the two terminal variables. Check the SSH man page for the reason
+                    os.environ["SSH_ASKPASS"] = ''
+                    os.environ["DISPLAY"] = ''
 
-                    output = p.before
+                    p = pexpect.spawn ("ssh %s %s@%s 'racadm %s'" %
+                                        (SSH_OPTIONS, self.user, self.system, command))
+                    p.setecho(True)
+                    p.logfile_read = pexpect_log(self.fout)
+                    timer.mark('spawn')
 
-                else:
-                    raise ("Error executing command '%s' at remote RACADM at %s [%d]" % (full_command, self.system, i))
+                    # React to whatever comes first instead of waiting for a fixed time
+                    start = time.time()
+                    i = p.expect (["%s@%s's password:" % (self.user, self.system), pexpect.EOF, pexpect.TIMEOUT, 'Error'],
+                                  timeout=connect_timeouts.get(self.system))
+                    if (i == 0):
+                        connect_timeouts.update(self.system, time.time() - start)
+                    elif (i == 2):
+                        connect_timeouts.expire(self.system)
+                    timer.mark('handshake')
+
+                    if (i == 0):
+                        # Authentication and the command itself can't be told apart here
+                        p.send(self.user_passwd + '\n')
+                        j = p.expect ([pexpect.EOF, pexpect.TIMEOUT, 'Error'], timeout=self.timeout, searchwindowsize=EXPECT_WINDOW)
+                        if (j != 0):
+                            raise Exception ("Error running command '%s' on system %s@%s [%d]" % (full_command, self.user, self.system, j))
+
+                        output = p.before
+                        timer.mark('command')
+                        self.__check_exit__(p, full_command)
+
+                    elif (i == 1):
+                        # No password was asked (key based login), the command already finished
+                        output = p.before
+                        self.__check_exit__(p, full_command)
+
+                    else:
+                        raise Exception ("Error executing command '%s' at remote RACADM at %s [%d]" % (full_command, self.system, i))
 
                 # Process the output
                 if (len(output) > 0):
@@ -188,12 +930,158 @@ class RacAdm(object):
                     output = "\n".join(output_lines)
 
         except Exception, e:
+            self._error = str(e)
             print ("execute exception: %s\n" % e)
         finally:
-            p.close()
+            if (p != None):
+                p.close()
+                timer.mark('teardown')
 
-        return output
+        self.timings = timer.timings
+        return RacAdmOutput(output, timer.timings)
 
+    def __check_exit__(self, p, full_command):
+        '''
+        Close the finished child, keep its exit status and fail if it is not zero
+        '''
+        p.close()
+        self._returncode = p.exitstatus
+        if (p.exitstatus == None):
+            # Killed by a signal, report it the way the shell does
+            self._returncode = 128 + p.signalstatus
+
+        if (self._returncode != 0):
+            raise Exception ("Error running command '%s' on system %s@%s [%s]" % (full_command, self.user, self.system, self._returncode))
+
+###############################################################################
+def read_list(file_name):
+    """
+    Read the list of systems or commands from the file, '-' means stdin.
+    One entry per line, '#' starts a comment.
+    """
+    entries = []
+    list_file = sys.stdin if (file_name == '-') else open(file_name)
+    try:
+        for line in list_file:
+            line = line.split('#', 1)[0].strip()
+            if (len(line) > 0):
+                entries.append(line)
+    finally:
+        if (list_file != sys.stdin):
+            list_file.close()
+    return entries
+
+def read_commands(file_name):
+    """
+    Read the list of RACADM commands, dropping the optional 'racadm' in front
+    """
+    return [re.sub(r'^racadm\s+', '', command) for command in read_list(file_name)]
+
+def fan_out(hosts, command, rac_system_user, rac_system_passwd,
+            workers=FAN_OUT_WORKERS, timeout=COMMAND_TIMEOUT, log_file=None, inventory=False):
+    """
+    Run the RACADM command on all the systems using a bounded pool of worker threads.
+    With inventory the inventory commands are answered from the inventory cache.
+    Returns the list of CommandResult objects in the order of the hosts.
+    """
+    hosts_queue = Queue.Queue()
+    for index, host in enumerate(hosts):
+        hosts_queue.put((index, host))
+
+    results = [None] * len(hosts)
+
+    def worker():
+        while True:
+            try:
+                index, host = hosts_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            fout = None
+            if (log_file != None):
+                fout = CleanFile ("%s.%s" % (log_file, host), 'w')
+
+            try:
+                start = time.time()
+                racadm = RacAdm(host, rac_system_user, rac_system_passwd, fout, timeout=timeout)
+                output = racadm.get_output(command, inventory)
+                results[index] = CommandResult(host, command, racadm.error, output, time.time() - start, racadm.returncode)
+            finally:
+                if (fout != None):
+                    fout.close()
+
+    threads = [threading.Thread(target=worker) for i in range(min(workers, len(hosts)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def print_results(results, column="host"):
+    """
+    Print the aggregated table of the fan out or batch results
+    """
+    print ("%-32s %-8s %9s  %s" % (column.upper(), "STATUS", "ELAPSED", "OUTPUT"))
+    for result in results:
+        status = "OK" if result else "ERROR"
+        if (result.returncode not in (0, None)):
+            status = "EXIT %d" % result.returncode
+        lines = result.output.splitlines() if result else [result.error]
+        if (len(lines) == 0):
+            lines = ['']
+
+        print ("%-32s %-8s %8.2fs  %s" % (getattr(result, column), status, result.elapsed, lines[0]))
+        for line in lines[1:]:
+            print ("%-32s %-8s %9s  %s" % ('', '', '', line))
+
+def summarize_timings(results):
+    """
+    Return the dictionary of phase -> (p50, p95) over all the results
+    """
+    summary = {}
+    for phase in TIMING_PHASES:
+        values = [result.timings[phase] for result in results if phase in result.timings]
+        if (len(values) > 0):
+            summary[phase] = (percentile(values, 50), percentile(values, 95))
+    return summary
+
+def print_timings(results):
+    """
+    Print the p50/p95 summary of the per-phase timings
+    """
+    summary = summarize_timings(results)
+    print ("%-12s %9s %9s" % ("PHASE", "P50", "P95"))
+    for phase in TIMING_PHASES:
+        if (phase in summary):
+            print ("%-12s %8.3fs %8.3fs" % ((phase,) + summary[phase]))
+
+def write_timings(results, file_name, file_format='json'):
+    """
+    Export the per-phase timings as JSON lines, one per command,
+    or as a Prometheus textfile with the p50/p95 summary
+    """
+    with open(file_name, 'w') as timings_file:
+        if (file_format == 'json'):
+            for result in results:
+                timings_file.write(json.dumps({
+                    'host':     result.host,
+                    'command':  result.command,
+                    'status':   "OK" if result else "ERROR",
+                    'elapsed':  result.elapsed,
+                    'timings':  result.timings,
+                }) + "\n")
+
+        else:
+            timings_file.write("# HELP racadm_phase_seconds Time spent in each phase of a RACADM command\n")
+            timings_file.write("# TYPE racadm_phase_seconds summary\n")
+            for phase, quantiles in sorted(summarize_timings(results).items()):
+                values = [result.timings[phase] for result in results if phase in result.timings]
+                timings_file.write('racadm_phase_seconds{phase="%s",quantile="0.5"} %f\n' % (phase, quantiles[0]))
+                timings_file.write('racadm_phase_seconds{phase="%s",quantile="0.95"} %f\n' % (phase, quantiles[1]))
+                timings_file.write('racadm_phase_seconds_sum{phase="%s"} %f\n' % (phase, sum(values)))
+                timings_file.write('racadm_phase_seconds_count{phase="%s"} %d\n' % (phase, len(values)))
 
 ###############################################################################
 def main():
@@ -220,6 +1108,37 @@ def main():
     parser.add_option("-c", "--command",type="string",dest="racadm_cmd",
         help="Command to run on RACADM",
         default=None)
+    parser.add_option("-k", "--keep-alive",action="store_true",dest="keep_alive",
+        help="Reuse one SSH session per remote system for all the commands")
+    parser.add_option("-i", "--idle-timeout",type="int",dest="idle_timeout",
+        help="Seconds before an unused SSH session is closed",
+        default=SESSION_IDLE_TIMEOUT)
+    parser.add_option("-f", "--hosts-file",type="string",dest="hosts_file",
+        help="File with the list of systems where RACADM resides, one per line",
+        default=None)
+    parser.add_option("-w", "--workers",type="int",dest="workers",
+        help="Number of systems to run the command on at the same time",
+        default=FAN_OUT_WORKERS)
+    parser.add_option("-t", "--timeout",type="int",dest="timeout",
+        help="Seconds to wait for the command on each system",
+        default=COMMAND_TIMEOUT)
+    parser.add_option("-b", "--batch-file",type="string",dest="batch_file",
+        help="File with the list of commands to run on RACADM, '-' to read them from stdin",
+        default=None)
+    parser.add_option("-e", "--stop-on-error",action="store_true",dest="stop_on_error",
+        help="Stop the batch at the first command which fails")
+    parser.add_option("-T", "--timings-file",type="string",dest="timings_file",
+        help="File to export the per-phase timings of the commands to",
+        default=None)
+    parser.add_option("-F", "--timings-format",type="choice",dest="timings_format",
+        choices=['json', 'prom'],
+        help="Format of the timings file: 'json' lines or 'prom' for the Prometheus textfile collector",
+        default='json')
+    parser.add_option("-C", "--inventory-file",type="string",dest="inventory_file",
+        help="Inventory snapshot file, inventory commands (%s) are answered from it and printed as JSON" % ', '.join(sorted(INVENTORY_PARSERS)),
+        default=None)
+    parser.add_option("-I", "--invalidate",action="store_true",dest="invalidate",
+        help="Drop the cached inventory of the systems before running the command")
 
     (options, args) = parser.parse_args()
 
@@ -227,19 +1146,67 @@ def main():
         print ("Script version: %s" % VER_STRING)
         return 0
 
+    hosts = [options.remote_system]
+    if (options.hosts_file != None):
+        hosts = read_list(options.hosts_file)
+
+    inventory = options.inventory_file != None
+    if (inventory):
+        inventories.load(options.inventory_file)
+    if (options.invalidate):
+        for host in hosts:
+            inventories.invalidate(host)
+
+    if (options.hosts_file != None):
+        results = fan_out(hosts, options.racadm_cmd,
+                          options.remote_system_user, options.remote_system_passwd,
+                          options.workers, options.timeout, options.log_file, inventory)
+        print_results(results)
+        print_timings(results)
+
+        if (options.timings_file != None):
+            write_timings(results, options.timings_file, options.timings_format)
+
+        if (not all(results)):
+            return 1
+
+        return 0
+
     fout = None
     if (options.log_file != None):
         fout = CleanFile (options.log_file, 'w')
 
-    racadm = RacAdm(options.remote_system, options.remote_system_user, options.remote_system_passwd, fout)
-    output = racadm.__execute_cmd__(options.racadm_cmd)
+    pool = None
+    if (options.keep_alive):
+        pool = RacAdmSessionPool(options.idle_timeout)
+
+    try:
+        racadm = RacAdm(options.remote_system, options.remote_system_user, options.remote_system_passwd, fout, pool, options.timeout)
+        if (options.batch_file != None):
+            results = racadm.run_batch(read_commands(options.batch_file), options.stop_on_error)
+            print_results(results, "command")
+            print_timings(results)
+            failed = not all(results)
+        else:
+            start = time.time()
+            output = racadm.get_output(options.racadm_cmd, inventory)
+            results = [CommandResult(racadm.system, options.racadm_cmd, racadm.error, output, time.time() - start, racadm.returncode)]
+            print output
+            failed = racadm.is_error()
+
+        if (options.timings_file != None):
+            write_timings(results, options.timings_file, options.timings_format)
+    finally:
+        if (pool != None):
+            pool.close_all()
 
-    print output
+        if (fout != None):
+            fout.close()
 
-    if (racadm.is_error()):
+    if (failed):
         return 1
 
     return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+    asyncio counterpart of the RacAdm class from headadm.py.
+    Every command is an asyncio subprocess, so thousands of RACADM commands can
+    be in flight on one event loop with cancellation and per-command timeouts.
+
+    The password is handed to ssh through SSH_ASKPASS since there is no
+    terminal to type it into.
+
+    General options:
+        -V, --version: Print the version of the script.
+        -s, --remote-system: System name where RACADM resides.
+        -f, --hosts-file: File with the list of systems to run the command on.
+        -w, --workers: Number of commands in flight at the same time.
+        -t, --timeout: Seconds to wait for the command on each system.
+        -c, --command: Command to run on RACADM
+
+"""
+
+import asyncio
+import atexit
+import optparse
+import os
+import re
+import shlex
+import signal
+import stat
+import sys
+import tempfile
+import time
+
+###############################################################################
+VER_STRING                  = "0.1"
+SSH_OPTIONS                 = ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                               '-o', 'NumberOfPasswordPrompts=1']
+COMMAND_TIMEOUT             = 120
+FAN_OUT_WORKERS             = 256
+ASKPASS_ENV                 = 'HEADADM_ASKPASS_PASSWD'
+
+_askpass_path = None
+
+###############################################################################
+def askpass_path():
+    """
+    Return the path of the SSH_ASKPASS helper which prints the password from
+    the environment, creating it on the first call
+    """
+    global _askpass_path
+
+    if (_askpass_path is None):
+        fd, path = tempfile.mkstemp(prefix='headadm-askpass-')
+        with os.fdopen(fd, 'w') as askpass:
+            askpass.write('#!/bin/sh\nprintf \'%%s\\n\' "$%s"\n' % ASKPASS_ENV)
+        os.chmod(path, stat.S_IRWXU)
+        atexit.register(os.remove, path)
+        _askpass_path = path
+
+    return _askpass_path
+
+def filterPick(lines, regex_str):
+    """
+    Remove from the list of strings string that match the supplied regex string
+    """
+    regex = re.compile(r'%s' % regex_str)
+    return [i for i in lines if not regex.match(i)]
+
+def kill_group(proc):
+    """
+    Kill the process together with everything it started in its session
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+###############################################################################
+class CommandResult(object):
+    """Result of running one RACADM command on one of the systems"""
+
+    def __init__(self, host, command, error, output, elapsed, returncode=None):
+        self.host = host
+        self.command = command
+        self.error = error
+        self.output = output
+        self.elapsed = elapsed
+        self.returncode = returncode
+
+    def __bool__(self):
+        """ True means good/success. """
+        return self.error == ''
+
+###############################################################################
+class AsyncRacAdm(object):
+    """Main class which abstracts asynchronous communication with a RACADM utility.
+    """
+
+    def __init__(self, rac_system='',
+                 rac_system_user='',
+                 rac_system_passwd='',
+                 timeout=COMMAND_TIMEOUT):
+        self._system = rac_system
+        self._user = rac_system_user
+        self.user_passwd = rac_system_passwd
+        self.local = False
+        self.timeout = timeout
+
+        if (rac_system == ''):
+            self.local = True
+
+    @property
+    def system(self):
+        """System to connect to. Empty if local"""
+        return self._system
+
+    @property
+    def user(self):
+        """Username for the system to connect to. Empty if local"""
+        return self._user
+
+    async def get_version(self):
+        """
+        Return the CommandResult of the RACADM version information
+        """
+        return await self.__execute_cmd__('getversion')
+
+    async def __execute_cmd__(self, command, timeout=None):
+        '''
+        Just run a simple command depending on the location - remote or local.
+        Returns the CommandResult, the object keeps no state of the command so
+        any number of them can run at the same time. Cancelling the task kills the command.
+        '''
+        full_command = 'racadm %s' % command
+        start = time.time()
+
+        if (self.local):
+            argv = ['racadm'] + shlex.split(command)
+            env = None
+        else:
+            argv = ['ssh'] + SSH_OPTIONS + ['%s@%s' % (self.user, self.system), full_command]
+            env = dict(os.environ)
+            env.update({
+                'SSH_ASKPASS':          askpass_path(),
+                'SSH_ASKPASS_REQUIRE':  'force',
+                'DISPLAY':              env.get('DISPLAY') or ':0',
+                ASKPASS_ENV:            self.user_passwd,
+            })
+
+        try:
+            # A new session has no controlling terminal, so ssh asks SSH_ASKPASS for the password
+            proc = await asyncio.create_subprocess_exec(
+                *argv, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, env=env, start_new_session=True)
+        except OSError as e:
+            error = "Error running command '%s': %s" % (full_command, e)
+            return CommandResult(self.system, command, error, "", time.time() - start)
+
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            kill_group(proc)
+            await proc.wait()
+            error = "Timeout running command '%s' on system %s@%s" % (full_command, self.user, self.system)
+            return CommandResult(self.system, command, error, "", time.time() - start, proc.returncode)
+        except asyncio.CancelledError:
+            kill_group(proc)
+            await proc.wait()
+            raise
+
+        error = ''
+        output = out.decode('utf8', 'replace')
+        if (proc.returncode != 0 or 'Error' in output):
+            error = "Error running command '%s' on system %s@%s [%d]: %s" % (
+                full_command, self.user, self.system, proc.returncode, err.decode('utf8', 'replace').strip())
+
+        # Sometimes there is a line complaining about some home directory
+        output_lines = filterPick(output.splitlines(), "^Could not chdir to home directory.+")
+
+        return CommandResult(self.system, command, error, "\n".join(output_lines), time.time() - start, proc.returncode)
+
+###############################################################################
+async def fan_out(hosts, command, rac_system_user, rac_system_passwd,
+                  workers=FAN_OUT_WORKERS, timeout=COMMAND_TIMEOUT):
+    """
+    Run the RACADM command on all the systems with at most 'workers' commands in flight.
+    Returns the list of CommandResult objects in the order of the hosts.
+    """
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run(host):
+        async with semaphore:
+            racadm = AsyncRacAdm(host, rac_system_user, rac_system_passwd, timeout)
+            return await racadm.__execute_cmd__(command)
+
+    return await asyncio.gather(*[run(host) for host in hosts])
+
+def read_list(file_name):
+    """
+    Read the list of systems from the file, '-' means stdin.
+    One entry per line, '#' starts a comment.
+    """
+    list_file = sys.stdin if (file_name == '-') else open(file_name)
+    with list_file:
+        return [line for line in (l.split('#', 1)[0].strip() for l in list_file) if len(line) > 0]
+
+###############################################################################
+def main():
+
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-V", "--version",action="store_true",dest="script_version",
+        help="Print script version and exit")
+    parser.add_option("-s", "--remote-system",type="string",dest="remote_system",
+        help="System name where RACADM resides",
+        default='')
+    parser.add_option("-u", "--remote-system-user",type="string",dest="remote_system_user",
+        help="User name at the system where RACADM resides",
+        default='')
+    parser.add_option("-p", "--remote-system-passwd",type="string",dest="remote_system_passwd",
+        help="Password for the user name at the system where RACADM resides",
+        default='')
+    parser.add_option("-f", "--hosts-file",type="string",dest="hosts_file",
+        help="File with the list of systems where RACADM resides, one per line",
+        default=None)
+    parser.add_option("-w", "--workers",type="int",dest="workers",
+        help="Number of commands in flight at the same time",
+        default=FAN_OUT_WORKERS)
+    parser.add_option("-t", "--timeout",type="int",dest="timeout",
+        help="Seconds to wait for the command on each system",
+        default=COMMAND_TIMEOUT)
+    parser.add_option("-c", "--command",type="string",dest="racadm_cmd",
+        help="Command to run on RACADM",
+        default='getversion')
+
+    (options, args) = parser.parse_args()
+
+    if (options.script_version):
+        print ("Script version: %s" % VER_STRING)
+        return 0
+
+    hosts = [options.remote_system]
+    if (options.hosts_file != None):
+        hosts = read_list(options.hosts_file)
+
+    results = asyncio.run(fan_out(hosts, options.racadm_cmd,
+                                  options.remote_system_user, options.remote_system_passwd,
+                                  options.workers, options.timeout))
+
+    print ("%-32s %-8s %9s  %s" % ("HOST", "STATUS", "ELAPSED", "OUTPUT"))
+    for result in results:
+        lines = result.output.splitlines() if result else [result.error]
+        if (len(lines) == 0):
+            lines = ['']
+
+        print ("%-32s %-8s %8.2fs  %s" % (result.host, "OK" if result else "ERROR", result.elapsed, lines[0]))
+        for line in lines[1:]:
+            print ("%-32s %-8s %9s  %s" % ('', '', '', line))
+
+    if (not all(results)):
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+    Benchmarks for headadm.py.
+    Measures the throughput of the pieces which are used when talking to RACADM.
+    No Dell hardware is needed: a fake 'racadm' and a fake 'ssh' with a password
+    prompt are put in front of the PATH. Their output size, latency and error
+    string are configurable.
+
+    General options:
+        -m, --size-mb: Size of the generated session transcript in MB.
+        -c, --chunk: Size of the single write, pexpect reads up to 2000 bytes at a time.
+        -n, --commands: Number of commands to run for each of the paths.
+        -S, --output-size: Size of the output of the fake racadm in bytes.
+        -L, --latency: Seconds the fake racadm takes to answer.
+        -H, --handshake: Seconds the fake ssh takes to ask for the password.
+        -E, --error: Make the fake racadm fail with this error string.
+        -b, --bench: Benchmarks to run: local, remote, keep-alive, log.
+
+"""
+
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import optparse
+
+import headadm
+
+###############################################################################
+BENCH_HOST                  = "bench-host"
+BENCH_USER                  = "root"
+BENCH_PASSWD                = "calvin"
+BENCH_ALL                   = "local,remote,keep-alive,log"
+
+FAKE_RACADM = '''#!%(python)s
+import os, sys, time
+time.sleep(float(os.environ.get('FAKE_RACADM_LATENCY', '0')))
+error = os.environ.get('FAKE_RACADM_ERROR', '')
+if (error != ''):
+    sys.stdout.write('%%s\\n' %% error)
+    sys.exit(1)
+size = int(os.environ.get('FAKE_RACADM_SIZE', '1024'))
+line = 'Key.%%08d = Value\\n'
+written = 0
+while (written < size):
+    sys.stdout.write(line %% written)
+    written += len(line) - 2
+sys.stdout.flush()
+'''
+
+FAKE_SSH = '''#!%(python)s
+import getpass, os, subprocess, sys, time
+args = sys.argv[1:]
+while (len(args) > 0 and args[0] == '-o'):
+    args = args[2:]
+target = args[0]
+command = ' '.join(args[1:])
+time.sleep(float(os.environ.get('FAKE_SSH_HANDSHAKE', '0')))
+if (getpass.getpass("%%s's password: " %% target) != os.environ.get('FAKE_SSH_PASSWD', '')):
+    sys.stdout.write('Permission denied\\n')
+    sys.exit(255)
+if (command != ''):
+    sys.exit(subprocess.call(command, shell=True))
+while True:
+    sys.stdout.write('/admin1-> ')
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if (line == '' or line.strip() == 'exit'):
+        break
+    subprocess.call(line, shell=True)
+'''
+
+###############################################################################
+def make_transcript(size):
+    """
+    Build a racadm like session transcript with the carriage returns, escape
+    sequences and backspaces which the terminal adds
+    """
+    rnd = random.Random(size)
+    lines = []
+    length = 0
+    while (length < size):
+        line = "InstanceID: NIC.Integrated.1-%d-1 = %08x\r\n" % (len(lines), rnd.getrandbits(32))
+        if (rnd.random() < 0.05):
+            line = "\x1b[0m" + line[:-2] + "xx\x08\x08\r\n"
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+def bench_clean_file(text, chunk):
+    """
+    Write the text through CleanFile in chunks and return the MB/s
+    """
+    fd, file_name = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        fout = headadm.CleanFile(file_name, 'w')
+        start = time.time()
+        for pos in xrange(0, len(text), chunk):
+            fout.write(text[pos:pos + chunk])
+            fout.flush()
+        fout.close()
+        elapsed = time.time() - start
+    finally:
+        os.remove(file_name)
+
+    return len(text) / (1024.0 * 1024.0) / elapsed
+
+###############################################################################
+def install_fakes(options):
+    """
+    Write the fake racadm and ssh into a temporary directory and put it in
+    front of the PATH. Returns the directory.
+    """
+    fake_dir = tempfile.mkdtemp(prefix='headadm-bench-')
+    for name, script in (('racadm', FAKE_RACADM), ('ssh', FAKE_SSH)):
+        path = os.path.join(fake_dir, name)
+        with open(path, 'w') as fake:
+            fake.write(script % {'python': sys.executable})
+        os.chmod(path, 0755)
+
+    os.environ['PATH'] = fake_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_RACADM_SIZE'] = str(options.output_size)
+    os.environ['FAKE_RACADM_LATENCY'] = str(options.latency)
+    os.environ['FAKE_RACADM_ERROR'] = options.error
+    os.environ['FAKE_SSH_HANDSHAKE'] = str(options.handshake)
+    os.environ['FAKE_SSH_PASSWD'] = BENCH_PASSWD
+
+    return fake_dir
+
+def bench_commands(racadm, count):
+    """
+    Run the command count times and return the list of CommandResult objects
+    """
+    results = []
+    for i in range(count):
+        start = time.time()
+        output = racadm.__execute_cmd__('getversion')
+        results.append(headadm.CommandResult(racadm.system, 'getversion', racadm.error, output, time.time() - start, racadm.returncode))
+    return results
+
+def print_bench(name, results, elapsed):
+    """
+    Print commands/second, per command latency and the peak memory
+    """
+    latencies = [result.elapsed for result in results]
+    failed = len([result for result in results if not result])
+    print ("%-12s %5d cmds %4d failed %8.2f cmds/s  p50 %7.3fs  p95 %7.3fs  maxrss %6d KB" %
+           (name, len(results), failed, len(results) / elapsed,
+            headadm.percentile(latencies, 50), headadm.percentile(latencies, 95),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+###############################################################################
+def main():
+
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--size-mb",type="int",dest="size_mb",
+        help="Size of the generated session transcript in MB",
+        default=8)
+    parser.add_option("-c", "--chunk",type="int",dest="chunk",
+        help="Size of the single write",
+        default=2000)
+    parser.add_option("-n", "--commands",type="int",dest="commands",
+        help="Number of commands to run for each of the paths",
+        default=20)
+    parser.add_option("-S", "--output-size",type="int",dest="output_size",
+        help="Size of the output of the fake racadm in bytes",
+        default=1024)
+    parser.add_option("-L", "--latency",type="float",dest="latency",
+        help="Seconds the fake racadm takes to answer",
+        default=0.0)
+    parser.add_option("-H", "--handshake",type="float",dest="handshake",
+        help="Seconds the fake ssh takes to ask for the password",
+        default=0.0)
+    parser.add_option("-E", "--error",type="string",dest="error",
+        help="Make the fake racadm fail with this error string",
+        default='')
+    parser.add_option("-b", "--bench",type="string",dest="bench",
+        help="Comma separated benchmarks to run: %s" % BENCH_ALL,
+        default=BENCH_ALL)
+
+    (options, args) = parser.parse_args()
+
+    benches = options.bench.split(',')
+    fake_dir = install_fakes(options)
+    try:
+        if ('local' in benches):
+            start = time.time()
+            results = bench_commands(headadm.RacAdm(''), options.commands)
+            print_bench('local', results, time.time() - start)
+
+        if ('remote' in benches):
+            start = time.time()
+            results = bench_commands(headadm.RacAdm(BENCH_HOST, BENCH_USER, BENCH_PASSWD), options.commands)
+            print_bench('remote', results, time.time() - start)
+
+        if ('keep-alive' in benches):
+            pool = headadm.RacAdmSessionPool()
+            start = time.time()
+            results = bench_commands(headadm.RacAdm(BENCH_HOST, BENCH_USER, BENCH_PASSWD, session_pool=pool), options.commands)
+            print_bench('keep-alive', results, time.time() - start)
+            pool.close_all()
+
+        if ('log' in benches):
+            text = make_transcript(options.size_mb * 1024 * 1024)
+            print ("CleanFile: %d MB transcript, %d byte writes: %.1f MB/s" %
+                   (options.size_mb, options.chunk, bench_clean_file(text, options.chunk)))
+    finally:
+        shutil.rmtree(fake_dir)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,9 +14,79 @@ Created on Sat Aug 08 15:58:20 2015
 
 """
 import sys, os, re
+import hashlib
+import mmap
+import tempfile
 import traceback
 import platform
 
+# Line tokens
+TOKEN_COMMENT = 0
+TOKEN_SECTION = 1
+TOKEN_DATA = 2
+
+# Bytes collected before writing them out in ini_data.dump()
+DUMP_BUFFER = 256 * 1024
+
+# Section header line as tokenize() sees it, the name runs up to the last ']'
+SECTION_PAT = re.compile(r'^[ \t\r\f\v]*\[(.*)\]', re.M)
+
+def tokenize(lines, hashes=None):
+    '''
+    Classify every line once by its first character and yield the tokens:
+    (TOKEN_COMMENT, comment, None), (TOKEN_SECTION, name, None) or
+    (TOKEN_DATA, key, value). Lines which are neither are skipped.
+    The raw lines of every section body are hashed into the hashes
+    dictionary if one is passed, the global scope is the None section.
+    '''
+    section = None
+    body = []
+    append = body.append
+
+    for raw_line in lines:
+        append(raw_line)
+        ini_line = raw_line.strip()
+        if (not ini_line):
+            continue
+
+        head = ini_line[0]
+        if (head == '#' or head == ';'):
+            yield (TOKEN_COMMENT, ini_line[1:], None)
+            continue
+        if (head == '/' and ini_line[1:2] == '/'):
+            yield (TOKEN_COMMENT, ini_line[2:], None)
+            continue
+        if (head == '['):
+            end = ini_line.rfind(']')
+            if (end > 0):
+                if (hashes != None):
+                    # The header line itself isn't part of the body
+                    del body[-1]
+                    hashes[section] = hashlib.md5(''.join(body)).digest()
+                    section = ini_line[1:end]
+                body = []
+                append = body.append
+                yield (TOKEN_SECTION, ini_line[1:end], None)
+                continue
+
+        # the key runs up to the last '=' and can't be empty
+        equal = ini_line.rfind('=')
+        if (equal > 0):
+            yield (TOKEN_DATA, ini_line[:equal].strip(), ini_line[equal + 1:].strip())
+
+    if (hashes != None):
+        hashes[section] = hashlib.md5(''.join(body)).digest()
+
+def diff_keys(old, new):
+    '''
+    Compare two dictionaries of key+value pairs.
+    Return the sorted lists of (added, removed, modified) keys.
+    '''
+    added = sorted(key for key in new if key not in old)
+    removed = sorted(key for key in old if key not in new)
+    modified = sorted(key for key in new if key in old and old[key] != new[key])
+    return (added, removed, modified)
+
 # ini file exception
 class iniException(Exception):
     def __init__(self, value):
@@ -40,101 +110,139 @@ class ini_data:
     # Dictionary of all INI entries
     _data = None
 
-    def __init__(self, file_name=None):
+    # Lazy mode: {section} -> (memory map of its file, start, end) of the
+    # sections which weren't parsed yet
+    _index = None
+
+    # Reload: file name, (mtime, size), mode and {section} -> content hash of
+    # the last parsed file. The global scope is the None section.
+    _file_name = None
+    _stat = None
+    _lazy = False
+    _hashes = None
+
+    def __init__(self, file_name=None, lazy=False):
         self._data = dict()
+        self._index = dict()
         if (None != file_name):
-            self.parse(file_name, False)
+            self.parse(file_name, False, lazy)
 
     def __str__(self):
-        output = ""
-        if (len(self._data) != 0):
-            # print the data in proper INI format
-            ini_int_data = self._data
-
-            # print the global comment
-            if (ini_int_data.has_key(self._comment_key) == True):
-                for comment in ini_int_data[self._comment_key]:
-                    output += ("%s %s\n" % (self._comment_head, comment))
-                output += "\n"
-
-            for section in ini_int_data:
-                if (section != self._comment_key):
-                    output += ("[%s]\n" % (section))
-                    section_dict = ini_int_data[section]
-
-                    # print the section comment
-                    if (section_dict.has_key(self._comment_key) == True):
-                        for comment in section_dict[self._comment_key]:
-                            output += ("%s %s\n" % (self._comment_head, comment))
-
-                    for key in section_dict:
-                        if (key != self._comment_key):
-                            output += ("%s=%s\n" % (key, section_dict[key]))
-
-                    output += "\n"
-
-            return output
-        else:
-            return output
+        return "".join(self.iter_chunks())
 
-    def parse(self, file_name, clear=True):
+    def iter_chunks(self):
+        '''
+        Yield the data in proper INI format, one chunk per scope.
+        Sections which weren't parsed yet are parsed for the output only.
+        '''
+        comment_key = self._comment_key
+        comment_format = self._comment_head + " %s\n"
+
+        # the global comment and key+values
+        lines = []
+        for comment in self._data.get(comment_key, []):
+            lines.append(comment_format % comment)
+        for key, value in self._data.iteritems():
+            if (key != comment_key and not isinstance(value, dict)):
+                lines.append("%s=%s\n" % (key, value))
+        if (len(lines) != 0):
+            lines.append("\n")
+            yield "".join(lines)
+
+        sections = [(section, section_dict) for section, section_dict in self._data.iteritems()
+                    if isinstance(section_dict, dict)]
+        for section in sorted(self._index, key=lambda section: self._index[section][1:]):
+            sections.append((section, None))
+
+        for section, section_dict in sections:
+            if (section_dict == None):
+                section_dict = self._parse_section(*self._index[section])
+
+            lines = ["[%s]\n" % section]
+            # the section comment
+            for comment in section_dict.get(comment_key, []):
+                lines.append(comment_format % comment)
+            for key, value in section_dict.iteritems():
+                if (key != comment_key):
+                    lines.append("%s=%s\n" % (key, value))
+            lines.append("\n")
+            yield "".join(lines)
+
+    def dump(self, ini_file):
         '''
-        Process the passed INI file and populate the internal structure
+        Write the data in proper INI format to the file object
+        '''
+        buffered = []
+        size = 0
+        for chunk in self.iter_chunks():
+            buffered.append(chunk)
+            size += len(chunk)
+            if (size >= DUMP_BUFFER):
+                ini_file.write("".join(buffered))
+                buffered = []
+                size = 0
+        ini_file.write("".join(buffered))
+
+    def save(self, file_name):
+        '''
+        Write the data to the file through a temporary file in the same
+        directory, so readers see either the old or the complete new file
+        '''
+        fd, temp_name = tempfile.mkstemp(prefix='.ini-', dir=os.path.dirname(os.path.abspath(file_name)))
+        try:
+            with os.fdopen(fd, 'w') as ini_file:
+                self.dump(ini_file)
+                ini_file.flush()
+                os.fsync(ini_file.fileno())
+            # mkstemp creates the file 0600, keep the mode of the file being replaced
+            if (os.path.exists(file_name)):
+                os.chmod(temp_name, os.stat(file_name).st_mode & 07777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_name, 0666 & ~umask)
+            if (os.name == 'nt' and os.path.exists(file_name)):
+                # rename doesn't replace the file on Windows
+                os.remove(file_name)
+            os.rename(temp_name, file_name)
+        except:
+            os.remove(temp_name)
+            raise
+
+        return True
+
+    def parse(self, file_name, clear=True, lazy=False):
+        '''
+        Process the passed INI file and populate the internal structure.
+        In lazy mode the file is memory mapped and only the global scope is
+        parsed, every section is parsed the first time it's accessed.
         '''
         status = True;
         if (clear == True):
             self._data.clear();
+            self._index.clear();
+            self._hashes = None
 
         try:
             if (os.path.isfile(file_name) == False):
                 print ("ERROR: ini file '%s' doesn't exist\n" % file_name);
                 return False;
+
+            if (self._hashes == None):
+                self._hashes = dict()
+            if (lazy == True):
+                with open(file_name, 'rb') as ini_file:
+                    stat = os.fstat(ini_file.fileno())
+                    if (stat.st_size != 0):
+                        self._scan(mmap.mmap(ini_file.fileno(), 0, access=mmap.ACCESS_READ))
             else:
-                ini_file = open(file_name);
-                ini_int_data = self._data;
-                global_scope = True;
-
-                for ini_line in ini_file:
-                    # skip the empty lines
-                    if (len(ini_line) == 0):
-                        continue
-
-                    ini_line = ini_line.strip()
-
-                    # Find if the line is a comment - starts from ;, #, //
-                    matchObj = re.match(r'^([#;]|/{2})(.*)', ini_line);
-                    if (None != matchObj):
-                        if (ini_int_data.has_key(self._comment_key) == False):
-                            ini_int_data[self._comment_key] = []
-                        ini_int_data[self._comment_key].append(matchObj.group(2));
-
-                        continue
-
-                    # Find if the line is a section in []
-                    matchObj = re.match(r'^\[(.*)\]', ini_line)
-                    if (None != matchObj):
-                        if (ini_int_data.has_key(matchObj.group(1)) == True):
-                            raise Exception("Duplicate section %s" % matchObj.group(1));
-                        else:
-                            # Create local dictionary for this section
-                            if (global_scope == True):
-                                global_scope = False
-                            else:
-                                ini_int_data = self._data
-
-                            ini_int_data[matchObj.group(1)] = dict()
-                            ini_int_data = ini_int_data[matchObj.group(1)]
-
-                        continue
-
-                    # Find if the line is some data. Error if not in a section.
-                    matchObj = re.match(r'^(.+)=(.*)', ini_line);
-                    if (None != matchObj):
-                        if (ini_int_data.has_key(matchObj.group(1)) == True):
-                            raise Exception("Duplicate key %s" % matchObj.group(1));
-                        else:
-                            # Add the key+values
-                            ini_int_data[matchObj.group(1).strip()] = matchObj.group(2).strip();
+                with open(file_name) as ini_file:
+                    stat = os.fstat(ini_file.fileno())
+                    self._fill(tokenize(ini_file, self._hashes), self._data)
+
+            self._file_name = file_name
+            self._stat = (stat.st_mtime, stat.st_size)
+            self._lazy = lazy
 
         except KeyError, e:
             print ("Error: %s" % e)
@@ -150,6 +258,162 @@ class ini_data:
 
         return status
 
+    def _fill(self, tokens, ini_int_data):
+        '''
+        Store the tokens starting in the ini_int_data scope
+        '''
+        comment_key = self._comment_key
+
+        for token, name, value in tokens:
+            if (token == TOKEN_DATA):
+                if (name in ini_int_data):
+                    raise iniException("Duplicate key %s" % name);
+                # Add the key+values
+                ini_int_data[name] = value;
+
+            elif (token == TOKEN_SECTION):
+                if (name in self._data or name in self._index):
+                    raise iniException("Duplicate section %s" % name);
+                # Create local dictionary for this section
+                ini_int_data = self._data[name] = dict()
+
+            else:
+                if (comment_key not in ini_int_data):
+                    ini_int_data[comment_key] = []
+                ini_int_data[comment_key].append(name);
+
+    def _scan(self, ini_map):
+        '''
+        Index and hash the sections of the mapped file without parsing them.
+        Only the global scope in front of the first section is parsed.
+        '''
+        # (section, start, end) of the section bodies
+        spans = []
+        section = None
+        start = 0
+
+        for matchObj in SECTION_PAT.finditer(ini_map):
+            spans.append((section, start, matchObj.start()))
+            section = matchObj.group(1)
+
+            # The section body starts on the next line
+            start = ini_map.find('\n', matchObj.end()) + 1
+            if (start == 0):
+                start = len(ini_map)
+
+        spans.append((section, start, len(ini_map)))
+
+        for section, start, end in spans:
+            if (section == None):
+                self._fill(tokenize(ini_map[start:end].splitlines()), self._data)
+            elif (section in self._data or section in self._index):
+                raise iniException("Duplicate section %s" % section);
+            else:
+                self._index[section] = (ini_map, start, end)
+            self._hashes[section] = hashlib.md5(ini_map[start:end]).digest()
+
+    def _parse_section(self, ini_map, start, end):
+        '''
+        Return the dictionary of the section body at ini_map[start:end]
+        '''
+        ini_int_data = dict()
+        self._fill(tokenize(ini_map[start:end].splitlines()), ini_int_data)
+        return ini_int_data
+
+    def _section(self, section):
+        '''
+        Return the dictionary of the section, parsing it on the first access.
+        None if the section doesn't exist.
+        '''
+        if (section in self._index):
+            # Keep the section indexed if it fails to parse
+            self._data[section] = self._parse_section(*self._index[section])
+            del self._index[section]
+
+        return self._data.get(section)
+
+    def reload(self):
+        '''
+        Re-read the file last passed to parse if its modification time or
+        size changed. The file is scanned for the section hashes and only the
+        changed sections are parsed again: after an eager parse right away,
+        after a lazy one when they are accessed.
+        Return the changes as
+        {'added': [sections], 'removed': [sections],
+         'modified': {section: ([added keys], [removed keys], [modified keys])}}
+        where the global scope is the None section, or None in case of the error.
+        The keys of a modified section are None if the section was never
+        accessed and the file was rewritten in place, so its old content is gone.
+        '''
+        changes = {'added': [], 'removed': [], 'modified': {}}
+        if (self._file_name == None):
+            raise iniException("Error: nothing to reload.")
+
+        try:
+            stat = os.stat(self._file_name)
+        except OSError, e:
+            print ("Error: %s" % e)
+            return None
+        if (self._stat == (stat.st_mtime, stat.st_size)):
+            return changes
+
+        old_data, old_index, old_hashes, lazy = self._data, self._index, self._hashes, self._lazy
+        self._data, self._index = dict(), dict()
+        if (self.parse(self._file_name, True, True) == False):
+            self._data, self._index, self._hashes, self._lazy = old_data, old_index, old_hashes, lazy
+            return None
+
+        if (lazy == False):
+            # Eager data stays eager, parse the changed and the new sections now
+            try:
+                for section in self._index.keys():
+                    if (old_hashes.get(section) != self._hashes[section]):
+                        self._section(section)
+            except iniException, e:
+                print ("Error: %s" % e)
+                for new_map in set(entry[0] for entry in self._index.itervalues()):
+                    new_map.close()
+                self._data, self._index, self._hashes, self._lazy = old_data, old_index, old_hashes, lazy
+                return None
+            self._lazy = False
+
+        old_sections = set(old_hashes)
+        new_sections = set(self._hashes)
+        old_sections.discard(None)
+        new_sections.discard(None)
+        for section in old_sections & new_sections:
+            if (old_hashes[section] == self._hashes[section]):
+                # Unchanged, keep it if it was parsed already
+                if (section in old_data):
+                    self._data[section] = old_data[section]
+                    del self._index[section]
+                continue
+
+            if (section in old_index):
+                # The old mapping shares the pages of the file, so it only
+                # holds the old content if the file was replaced rather than
+                # rewritten in place. Reading past the end of a truncated file faults.
+                old_map, start, end = old_index[section]
+                end = min(end, stat.st_size)
+                if (hashlib.md5(old_map[start:end]).digest() != old_hashes[section]):
+                    changes['modified'][section] = None
+                    continue
+                old_data[section] = self._parse_section(old_map, start, end)
+            changes['modified'][section] = diff_keys(old_data[section], self._section(section))
+
+        for old_map in set(entry[0] for entry in old_index.itervalues()):
+            old_map.close()
+
+        changes['added'] = sorted(new_sections - old_sections)
+        changes['removed'] = sorted(old_sections - new_sections)
+
+        old_global = dict((key, value) for key, value in old_data.iteritems() if not isinstance(value, dict))
+        new_global = dict((key, value) for key, value in self._data.iteritems() if not isinstance(value, dict))
+        if (old_global != new_global):
+            changes['modified'][None] = diff_keys(old_global, new_global)
+
+        return changes
+
     def add_comment(self, comment, section=None):
         '''
         Add comment string to the specified section,
@@ -157,7 +421,7 @@ class ini_data:
         '''
         ini_int_data = self._data
         if (section != None):
-            if (ini_int_data.has_key(section) == False):
+            if (self._section(section) == None):
                 ini_int_data[section] = dict()
 
             ini_int_data = ini_int_data[section]
@@ -181,7 +445,7 @@ class ini_data:
         Create section if it doesn't exist.
         '''
         ini_int_data = self._data
-        if (ini_int_data.has_key(section) == False):
+        if (self._section(section) == None):
             ini_int_data[section] = dict()
 
         # Exit if we only want to add a section
@@ -206,7 +470,7 @@ class ini_data:
         Return value or list. Throw iniException in case of the error
         '''
         ini_int_data = self._data
-        if (ini_int_data.has_key(section) == False):
+        if (self._section(section) == None):
             raise iniException ("Error: section '%s' doesn't exist." % section)
 
         ini_int_data = ini_int_data[section]
@@ -232,7 +496,7 @@ class ini_data:
         Return true if the specified key exist in the specified section
         '''
         ini_int_data = self._data
-        if (ini_int_data.has_key(section) == False):
+        if (self._section(section) == None):
             return False
 
         # Find the values
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+    Benchmarks for ini_parser.py.
+    Generates synthetic INI files of the requested sizes, parses each of them
+    in a fresh process and reports lines/second and the peak memory.
+
+    General options:
+        -s, --sizes: Comma separated sizes of the generated INI files in MB.
+        -k, --keys: Number of keys in each of the sections.
+        -d, --dir: Directory for the generated files.
+        -l, --lazy: Memory map the files and only look up one key of one section.
+        -o, --dump: Also write the parsed data back out to a temporary file.
+
+"""
+
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import optparse
+
+import ini_parser
+
+###############################################################################
+BENCH_SIZES                 = "1,100,1024"
+BENCH_KEYS                  = 50
+
+###############################################################################
+def make_ini(file_name, size, keys):
+    """
+    Write an inventory like INI file of about size bytes with comments,
+    sections and key=value lines. Returns the number of lines.
+    """
+    rnd = random.Random(size)
+    lines = 0
+    written = 0
+    with open(file_name, 'w') as ini_file:
+        ini_file.write("# generated by ini_parser_bench\n")
+        section = 0
+        while (written < size):
+            chunk = ["[NIC.Integrated.1-%d-1]\n" % section, "; port %d\n" % section]
+            for key in xrange(keys):
+                chunk.append("Key.%04d = %08x\n" % (key, rnd.getrandbits(32)))
+            chunk.append("\n")
+            chunk = ''.join(chunk)
+            ini_file.write(chunk)
+            written += len(chunk)
+            lines += keys + 3
+            section += 1
+    return lines
+
+def bench_parse(file_name, lines, lazy=False, dump=False):
+    """
+    Parse the file in a child process so the peak memory is its own.
+    Returns (lines/s, peak memory in KB).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if (pid == 0):
+        os.close(read_fd)
+        start = time.time()
+        ini = ini_parser.ini_data()
+        status = ini.parse(file_name, lazy=lazy)
+        if (status and lazy):
+            ini.get_data(max(ini._index), 'Key.0000')
+        if (status and dump):
+            status = ini.save(file_name + '.out')
+            os.remove(file_name + '.out')
+        elapsed = time.time() - start
+        os.write(write_fd, "%d %f %d" % (status, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024).split()
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    if (len(result) != 3 or result[0] != '1'):
+        return (0.0, 0)
+    return (lines / float(result[1]), int(result[2]))
+
+###############################################################################
+def main():
+
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-s", "--sizes",type="string",dest="sizes",
+        help="Comma separated sizes of the generated INI files in MB",
+        default=BENCH_SIZES)
+    parser.add_option("-k", "--keys",type="int",dest="keys",
+        help="Number of keys in each of the sections",
+        default=BENCH_KEYS)
+    parser.add_option("-d", "--dir",type="string",dest="dir",
+        help="Directory for the generated files",
+        default=None)
+    parser.add_option("-l", "--lazy",action="store_true",dest="lazy",
+        help="Memory map the files and only look up one key of one section",
+        default=False)
+    parser.add_option("-o", "--dump",action="store_true",dest="dump",
+        help="Also write the parsed data back out to a temporary file",
+        default=False)
+
+    (options, args) = parser.parse_args()
+
+    print ("%8s %12s %12s %12s" % ("MB", "lines", "lines/s", "peak KB"))
+    for size_mb in [int(size) for size in options.sizes.split(',')]:
+        fd, file_name = tempfile.mkstemp(suffix='.ini', dir=options.dir)
+        os.close(fd)
+        try:
+            lines = make_ini(file_name, size_mb * 1024 * 1024, options.keys)
+            rate, peak = bench_parse(file_name, lines, options.lazy, options.dump)
+        finally:
+            os.remove(file_name)
+        print ("%8d %12d %12.0f %12d" % (size_mb, lines, rate, peak))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())